@@ -0,0 +1,217 @@
+import logging
+import os
+import sqlite3
+from datetime import datetime
+from DB import db
+from Exceptions import exceptions
+from Metrics import metrics
+
+# Cold storage for old messages. Messages older than the configured age are
+# moved out of the hot database into one SQLite file per month, each with its
+# own full text index. The archive_segments table in the hot database lists
+# the files and the time range they cover, so archived messages can still be
+# searched and exported without touching the other months.
+
+log = logging.getLogger(__name__)
+
+# The format SQLAlchemy uses for DateTime columns in SQLite, so both the hot
+# database and the segments compare dates the same way.
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+SEGMENT_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS messages (
+        message_id INTEGER PRIMARY KEY,
+        message_author VARCHAR(255),
+        message_content VARCHAR(255),
+        message_datetime DATETIME)""",
+    """CREATE INDEX IF NOT EXISTS ix_messages_datetime ON
+        messages (message_datetime)""",
+]
+
+def segment_path(archive_dir: str, month: str) -> str:
+    return os.path.join(archive_dir, f"messages-{month}.sqlite3")
+
+def open_segment(path: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(path)
+    for statement in SEGMENT_SCHEMA:
+        connection.execute(statement)
+    create_search_index(connection)
+    return connection
+
+def create_search_index(connection: sqlite3.Connection) -> bool:
+    # Same as db.create_search_index for a segment: without FTS5 the messages
+    # are archived anyway and only searching the archive is unavailable.
+    indexed = connection.execute("SELECT 1 FROM sqlite_master WHERE "\
+            + "type = 'table' AND name = ?", (db.SEARCH_TABLE,)).fetchone()
+    try:
+        for statement in db.SEARCH_SCHEMA:
+            connection.execute(statement)
+        if indexed is None:
+            connection.execute(f"INSERT INTO {db.SEARCH_TABLE}("\
+                    + f"{db.SEARCH_TABLE}) VALUES ('rebuild')")
+        connection.commit()
+        return True
+    except sqlite3.OperationalError as e:
+        connection.rollback()
+        log.warning(f"Archive search is unavailable: {str(e)}.")
+        return False
+
+def archive_batch(session, archive_dir: str, cutoff: datetime,
+                    batch_size: int = 1000) -> int:
+    # Moves up to batch_size of the oldest messages created before cutoff
+    # into their monthly segments and returns how many were moved. Meant to
+    # be called repeatedly, each call is a short write transaction so the
+    # ingestion writer is never held up for long.
+    messages = session.query(db.Message).filter(
+            db.Message.message_datetime < cutoff).order_by(
+            db.Message.message_datetime).limit(batch_size).all()
+    if not messages:
+        return 0
+    if not os.path.exists(archive_dir):
+        os.makedirs(archive_dir)
+    months = {}
+    for message in messages:
+        months.setdefault(message.message_datetime.strftime("%Y-%m"),
+                []).append(message)
+    try:
+        for month, month_messages in months.items():
+            # The segment is written and committed first. If the bot stops
+            # before the messages are deleted below, the next run writes them
+            # again, which the upsert turns into a no-op.
+            path = segment_path(archive_dir, month)
+            connection = open_segment(path)
+            try:
+                with connection:
+                    connection.executemany("INSERT INTO messages "\
+                            + "(message_id, message_author, message_content, "\
+                            + "message_datetime) VALUES (?, ?, ?, ?) "\
+                            + "ON CONFLICT(message_id) DO UPDATE SET "\
+                            + "message_author = excluded.message_author, "\
+                            + "message_content = excluded.message_content",
+                            [(message.message_id, message.message_author,
+                            message.message_content,
+                            message.message_datetime.strftime(DATETIME_FORMAT))
+                            for message in month_messages])
+                count, first, last = connection.execute("SELECT count(*), "\
+                        + "min(message_datetime), max(message_datetime) "\
+                        + "FROM messages").fetchone()
+            finally:
+                connection.close()
+            segment = session.query(db.ArchiveSegment).filter(
+                    db.ArchiveSegment.segment_month == month).first()
+            if segment is None:
+                segment = db.ArchiveSegment(segment_month=month)
+                session.add(segment)
+            segment.segment_file = path
+            segment.segment_messages = count
+            segment.segment_first = datetime.strptime(first, DATETIME_FORMAT)
+            segment.segment_last = datetime.strptime(last, DATETIME_FORMAT)
+        session.query(db.Message).filter(db.Message.message_id.in_(
+                [message.message_id for message in messages])).delete(
+                synchronize_session=False)
+        session.commit()
+    except Exception as e:
+        log.exception(f"Could not archive messages: {str(e)}.")
+        session.rollback()
+        raise e
+    metrics.MESSAGES_ARCHIVED.inc(len(messages))
+    return len(messages)
+
+def get_segments(session, since: datetime = None,
+                    until: datetime = None) -> list:
+    # Segments overlapping [since, until), newest first.
+    query = session.query(db.ArchiveSegment)
+    if since is not None:
+        query = query.filter(db.ArchiveSegment.segment_last >= since)
+    if until is not None:
+        query = query.filter(db.ArchiveSegment.segment_first < until)
+    return query.order_by(db.ArchiveSegment.segment_month.desc()).all()
+
+def _segment_conditions(author: str, since: datetime,
+                            until: datetime) -> tuple:
+    conditions = []
+    params = []
+    if author is not None:
+        conditions.append("messages.message_author = ?")
+        params.append(author)
+    if since is not None:
+        conditions.append("messages.message_datetime >= ?")
+        params.append(since.strftime(DATETIME_FORMAT))
+    if until is not None:
+        conditions.append("messages.message_datetime < ?")
+        params.append(until.strftime(DATETIME_FORMAT))
+    return conditions, params
+
+def _message(row) -> db.Message:
+    return db.Message(message_id=row[0], message_author=row[1],
+            message_content=row[2],
+            message_datetime=datetime.strptime(row[3], DATETIME_FORMAT))
+
+def search_archive(
+                    session,
+                    terms: list,
+                    author: str = None,
+                    since: datetime = None,
+                    until: datetime = None,
+                    page: int = 1,
+                    per_page: int = 10
+                ) -> tuple:
+    # Same as db.search_messages but over the archived months, newest month
+    # first and best matches (or newest messages, without terms) first within
+    # a month. Only the segments that overlap the date range are opened.
+    match = db._match_query(terms)
+    wanted = max(page, 1) * per_page + 1
+    conditions, params = _segment_conditions(author, since, until)
+    columns = "SELECT messages.message_id, messages.message_author, "\
+            + "messages.message_content, messages.message_datetime FROM "
+    if match:
+        statement = columns + f"{db.SEARCH_TABLE} JOIN messages ON "\
+                + f"messages.message_id = {db.SEARCH_TABLE}.rowid WHERE "\
+                + " AND ".join([f"{db.SEARCH_TABLE} MATCH ?"] + conditions)\
+                + " ORDER BY rank LIMIT ?"
+        params = [match] + params
+    elif conditions:
+        statement = columns + "messages WHERE " + " AND ".join(conditions)\
+                + " ORDER BY messages.message_datetime DESC LIMIT ?"
+    else:
+        return [], False
+    found = []
+    for segment in get_segments(session, since, until):
+        if not os.path.exists(segment.segment_file):
+            log.warning(f"Archive segment {segment.segment_file} is missing.")
+            continue
+        connection = sqlite3.connect(segment.segment_file)
+        try:
+            found.extend(connection.execute(statement,
+                    params + [wanted - len(found)]).fetchall())
+        except sqlite3.OperationalError as e:
+            if f"no such table: {db.SEARCH_TABLE}" in str(e):
+                raise exceptions.SearchUnavailableException()
+            raise e
+        finally:
+            connection.close()
+        if len(found) >= wanted:
+            break
+    results = found[(max(page, 1) - 1) * per_page:]
+    return [_message(row) for row in results[:per_page]], \
+            len(results) > per_page
+
+def iter_archived_messages(session, since: datetime = None,
+                            until: datetime = None):
+    # Streams archived messages oldest first, one segment at a time, without
+    # loading a whole month into memory.
+    conditions, params = _segment_conditions(None, since, until)
+    where = " WHERE " + " AND ".join(conditions) if conditions else ""
+    for segment in reversed(get_segments(session, since, until)):
+        if not os.path.exists(segment.segment_file):
+            log.warning(f"Archive segment {segment.segment_file} is missing.")
+            continue
+        connection = sqlite3.connect(segment.segment_file)
+        try:
+            cursor = connection.execute("SELECT message_id, message_author, "\
+                    + "message_content, message_datetime FROM messages"\
+                    + where + " ORDER BY message_datetime", params)
+            for row in cursor:
+                yield _message(row)
+        finally:
+            connection.close()
@@ -0,0 +1,255 @@
+#!/usr/bin/python3
+# Benchmarks for the ingestion and voting paths, run against a temporary
+# SQLite file with the real DB.db functions and fake Discord channels.
+#
+#   python3 -m Bench.bench --messages 10000,100000 --proposals 10,100 \
+#       --instances 3 --output bench_results.json
+import argparse
+import asyncio
+import configparser
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta
+from DB import db
+from DB import executor
+from Ingest import ingest
+from Lease import lease
+from Bench import fakes
+
+START = datetime(2022, 1, 1)
+AUTHORS = [f"membro{i}" for i in range(200)]
+
+def make_database(directory: str, threads: int):
+    options = configparser.ConfigParser()
+    options.read_dict({"DATABASE": {
+        "TYPE": "sqlite",
+        "FILE": os.path.join(directory, "storage.sqlite3"),
+        "USER": "bench",
+        "PASS": "bench",
+    }})
+    return executor.DatabaseExecutor(db.get_database(options), threads)
+
+def percentile(values: list, fraction: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+async def bench_backfill(database, messages: int, channels: int,
+                            page_size: int, concurrency: int) -> dict:
+    fake_channels = [fakes.FakeChannel(1000 + i) for i in range(channels)]
+    next_id = 1
+    for channel in fake_channels:
+        next_id = fakes.generate_messages(channel, messages // channels,
+                AUTHORS, next_id, START)
+    bot = fakes.FakeBot(database, fake_channels)
+    writer = ingest.MessageWriter(database, page_size)
+    scheduler = ingest.ChannelScheduler(bot, writer, concurrency, page_size)
+    start = time.perf_counter()
+    inserted = await asyncio.gather(*[scheduler.fetch(channel,
+            ingest.ChannelStats(0)) for channel in fake_channels])
+    elapsed = time.perf_counter() - start
+    return {"messages": sum(inserted), "seconds": elapsed,
+            "messages_per_second": sum(inserted) / elapsed}
+
+async def bench_live(database, messages: int, batch_size: int) -> dict:
+    channel = fakes.FakeChannel(1)
+    # IDs above anything the backfill benchmark stored.
+    fakes.generate_messages(channel, messages, AUTHORS, 10 ** 7, START)
+    writer = ingest.MessageWriter(database, batch_size, flush_interval=0.05)
+    task = asyncio.ensure_future(writer.run())
+    start = time.perf_counter()
+    for message in channel.messages:
+        await writer.put(message)
+    while writer.inserted < messages:
+        await asyncio.sleep(0.005)
+    elapsed = time.perf_counter() - start
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    return {"messages": messages, "seconds": elapsed,
+            "messages_per_second": messages / elapsed}
+
+async def bench_votes(database, proposals: int, voters: int,
+                        concurrency: int) -> dict:
+    proposal_ids = []
+    for i in range(proposals):
+        proposal = await database.run(db.add_proposal, f"Proposta {i}",
+                "bench", ["Sim", "Não", "Talvez", "Abstenção"], 1)
+        proposal_ids.append(proposal.proposal_id)
+    votes = fakes.generate_votes(proposal_ids, voters, 4)
+    semaphore = asyncio.Semaphore(concurrency)
+    add_latencies = []
+    move_latencies = []
+
+    async def cast(vote):
+        async with semaphore:
+            start = time.perf_counter()
+            await database.run(db.add_vote, *vote)
+            add_latencies.append(time.perf_counter() - start)
+
+    async def move(vote):
+        proposal_id, option, author = vote
+        async with semaphore:
+            start = time.perf_counter()
+            await database.run(db.move_vote, proposal_id, option % 4 + 1,
+                    author)
+            move_latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[cast(vote) for vote in votes])
+    elapsed = time.perf_counter() - start
+    await asyncio.gather(*[move(vote) for vote in votes[::10]])
+    return {"proposals": proposals, "votes": len(votes), "seconds": elapsed,
+            "votes_per_second": len(votes) / elapsed,
+            "vote_p50_ms": percentile(add_latencies, 0.5) * 1000,
+            "vote_p99_ms": percentile(add_latencies, 0.99) * 1000,
+            "move_p50_ms": percentile(move_latencies, 0.5) * 1000,
+            "move_p99_ms": percentile(move_latencies, 0.99) * 1000,
+            "proposal_ids": proposal_ids}
+
+async def bench_instances(directory: str, messages: int, channels: int,
+                            instances: int, args) -> dict:
+    # Several bot instances on the same database file, each with its own
+    # engine and threads like separate processes, all configured with the
+    # same channels. The channel leases must split the channels between them
+    # so every message is read once. Then the instance holding the most
+    # leases stops without releasing them, and the time until the others
+    # have taken over all of its channels is measured.
+    fake_channels = [fakes.FakeChannel(2000 + i) for i in range(channels)]
+    next_id = 10 ** 8
+    for channel in fake_channels:
+        next_id = fakes.generate_messages(channel, messages // channels,
+                AUTHORS, next_id, START)
+    databases = [make_database(directory, args.threads)
+            for i in range(instances)]
+    bots = [fakes.FakeBot(database, fake_channels) for database in databases]
+    keepers = [lease.LeaseKeeper(database, f"instance{i}", args.lease_seconds)
+            for i, database in enumerate(databases)]
+    schedulers = [ingest.ChannelScheduler(bot, ingest.MessageWriter(
+            bot.database, args.batch_size), args.concurrency, args.batch_size,
+            min_interval=args.lease_seconds / 10, max_interval=
+            args.lease_seconds / 10, leases=keeper)
+            for bot, keeper in zip(bots, keepers)]
+    tasks = [asyncio.ensure_future(keeper.run(bot.is_closed))
+            for bot, keeper in zip(bots, keepers)]
+    tasks += [asyncio.ensure_future(scheduler.run(bot.channels))
+            for bot, scheduler in zip(bots, schedulers)]
+    start = time.perf_counter()
+    while sum(stats.messages for scheduler in schedulers
+            for stats in scheduler.stats.values()) < messages:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    held = [len(keeper.held) for keeper in keepers]
+    stopped = held.index(max(held))
+    orphaned = set(keepers[stopped].held)
+    bots[stopped].closed = True
+    tasks[stopped].cancel()
+    stop = time.perf_counter()
+    while orphaned - set().union(*[keeper.held for i, keeper
+            in enumerate(keepers) if i != stopped]):
+        await asyncio.sleep(0.01)
+    failover = time.perf_counter() - stop
+    for bot in bots:
+        bot.closed = True
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for database in databases:
+        database.shutdown()
+    return {"instances": instances, "messages": sum(stats.messages
+            for scheduler in schedulers for stats in scheduler.stats.values()),
+            "seconds": elapsed, "leases_held": held,
+            "failover_seconds": failover}
+
+def expire_proposals(session, proposal_ids: list):
+    session.query(db.Proposal).filter(db.Proposal.proposal_id.in_(
+            proposal_ids)).update({db.Proposal.proposal_expiration:
+            datetime.now() - timedelta(seconds=1)}, synchronize_session=False)
+    session.commit()
+
+async def bench_close(database, proposal_ids: list) -> dict:
+    await database.run(expire_proposals, proposal_ids)
+    start = time.perf_counter()
+    closed = await database.run(db.update_expiring_proposals)
+    elapsed = time.perf_counter() - start
+    return {"proposals": len(closed), "seconds": elapsed}
+
+async def run_scale(messages: int, proposals: int, args) -> dict:
+    directory = tempfile.mkdtemp(prefix="jardins-bench-")
+    database = make_database(directory, args.threads)
+    try:
+        result = {"messages": messages, "proposals": proposals,
+                "voters": args.voters}
+        result["backfill"] = await bench_backfill(database, messages,
+                args.channels, args.batch_size, args.concurrency)
+        result["live"] = await bench_live(database, messages, args.batch_size)
+        votes = await bench_votes(database, proposals, args.voters,
+                args.concurrency)
+        result["close"] = await bench_close(database,
+                votes.pop("proposal_ids"))
+        result["votes"] = votes
+        if args.instances > 1:
+            result["instances"] = await bench_instances(directory, messages,
+                    args.channels, args.instances, args)
+        result["database"] = database.stats()
+        return result
+    finally:
+        database.shutdown()
+        shutil.rmtree(directory, ignore_errors=True)
+
+def parse_sizes(text: str) -> list:
+    return [int(size) for size in text.split(',')]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark message "\
+            + "ingestion, voting and proposal closing.")
+    parser.add_argument("--messages", type=parse_sizes, default=[10000],
+            help="comma separated numbers of messages to ingest")
+    parser.add_argument("--proposals", type=parse_sizes, default=[10],
+            help="comma separated numbers of proposals to vote on")
+    parser.add_argument("--voters", type=int, default=50)
+    parser.add_argument("--channels", type=int, default=8)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--instances", type=int, default=1,
+            help="also run this many instances sharing the database")
+    parser.add_argument("--lease-seconds", type=float, default=2)
+    parser.add_argument("--output", default="bench_results.json")
+    args = parser.parse_args()
+    if len(args.messages) != len(args.proposals):
+        # Pair every message count with every proposal count.
+        scales = [(messages, proposals) for messages in args.messages
+                for proposals in args.proposals]
+    else:
+        scales = list(zip(args.messages, args.proposals))
+    results = []
+    for messages, proposals in scales:
+        result = asyncio.run(run_scale(messages, proposals, args))
+        results.append(result)
+        print(f"{messages} messages: backfill "\
+            + f"{result['backfill']['messages_per_second']:.0f} msg/s, live "\
+            + f"{result['live']['messages_per_second']:.0f} msg/s. "\
+            + f"{proposals} proposals: vote p50 "\
+            + f"{result['votes']['vote_p50_ms']:.2f} ms, p99 "\
+            + f"{result['votes']['vote_p99_ms']:.2f} ms, close "\
+            + f"{result['close']['seconds'] * 1000:.1f} ms.")
+        if "instances" in result:
+            print(f"{args.instances} instances: leases "\
+                + f"{result['instances']['leases_held']}, failover "\
+                + f"{result['instances']['failover_seconds']:.2f} s.")
+    with open(args.output, 'w') as output:
+        json.dump({"date": datetime.now().isoformat(),
+                "python": platform.python_version(),
+                "results": results}, output, indent=2)
+    print(f"Results written to {args.output}.")
+
+if __name__ == "__main__":
+    main()
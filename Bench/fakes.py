@@ -0,0 +1,98 @@
+import asyncio
+import random
+from datetime import datetime, timedelta
+
+# Local stand-ins for the parts of discord.py the bot uses, so the ingestion
+# and voting paths can be driven without a Discord server.
+
+class FakeAuthor:
+    def __init__(self, display_name: str):
+        self.display_name = display_name
+        self.mention = f"@{display_name}"
+
+class FakeMessage:
+    def __init__(self, message_id: int, author: FakeAuthor,
+                    created_at: datetime, content: str, channel=None):
+        self.id = message_id
+        self.author = author
+        self.created_at = created_at
+        self.clean_content = content
+        self.channel = channel
+
+class FakeHistory:
+    # Behaves like discord.py's HistoryIterator: fetches pages of 100
+    # messages and yields to the event loop between pages, like an API call.
+    def __init__(self, messages: list, after, oldest_first: bool,
+                    latency: float):
+        self.messages = messages
+        self.after = after
+        self.oldest_first = oldest_first
+        self.latency = latency
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        if isinstance(self.after, datetime):
+            messages = [message for message in self.messages
+                    if message.created_at > self.after]
+        elif self.after is not None:
+            messages = [message for message in self.messages
+                    if message.id > self.after.id]
+        else:
+            messages = list(self.messages)
+        if not self.oldest_first:
+            messages.reverse()
+        for start in range(0, len(messages), 100):
+            await asyncio.sleep(self.latency)
+            for message in messages[start:start + 100]:
+                yield message
+
+class FakeChannel:
+    def __init__(self, channel_id: int, latency: float = 0):
+        self.id = channel_id
+        self.latency = latency
+        self.messages = []
+        self.sent = []
+
+    def history(self, limit=None, after=None, oldest_first=None):
+        if oldest_first is None:
+            oldest_first = after is not None
+        return FakeHistory(self.messages, after, oldest_first, self.latency)
+
+    async def send(self, content: str):
+        self.sent.append(content)
+
+class FakeBot:
+    # Just enough of commands.Bot for the Ingest and Scheduler modules.
+    def __init__(self, database, channels: list):
+        self.database = database
+        self.session = database.session_factory
+        self.channels_by_id = {channel.id: channel for channel in channels}
+        self.channels = [str(channel.id) for channel in channels]
+        self.closed = False
+
+    def get_channel(self, channel_id: int):
+        return self.channels_by_id.get(channel_id)
+
+    def is_closed(self) -> bool:
+        return self.closed
+
+def generate_messages(channel: FakeChannel, count: int, authors: list,
+                        first_id: int, start: datetime) -> int:
+    # Appends count messages to the channel and returns the next free ID.
+    # IDs grow with time, like Discord snowflakes.
+    for i in range(count):
+        author = FakeAuthor(random.choice(authors))
+        channel.messages.append(FakeMessage(first_id + i, author,
+                start + timedelta(seconds=first_id + i),
+                f"mensagem {first_id + i} " + "palavra " * random.randint(1, 20),
+                channel))
+    return first_id + count
+
+def generate_votes(proposal_ids: list, voters: int, options: int) -> list:
+    # One (proposal_id, option, author) per voter and proposal, shuffled.
+    votes = [(proposal_id, random.randint(1, options), f"membro{voter}")
+            for proposal_id in proposal_ids for voter in range(voters)]
+    random.shuffle(votes)
+    return votes
@@ -1,5 +1,6 @@
 import os
 import configparser
+from Exceptions import exceptions
 
 def read_config(config_file_path=None):
     if not config_file_path:
@@ -7,20 +8,45 @@ def read_config(config_file_path=None):
             ".JardinsEfemerosBot/bot.conf")
     if not os.path.exists(config_file_path):
         write_default_config(config_file_path)
-    config = configparser.SafeConfigParser()
+        raise exceptions.ConfigCreatedException(f"Config file "\
+            + f"{config_file_path} written! Please modify the config file "\
+            + "and re-run the program!")
+    config = configparser.ConfigParser()
     config.read(config_file_path)
     return config
 
 def write_default_config(config_file_path):
     if not os.path.exists(os.path.dirname(config_file_path)):
         os.makedirs(os.path.dirname(config_file_path))
-    config = configparser.SafeConfigParser()
+    config = configparser.ConfigParser()
     config.add_section("SECRET")
     config.set("SECRET", "TOKEN", "<fill in with your bot token>")
     config.add_section("BOT")
     config.set("BOT", "PREFIX", "!")
     config.set("BOT", "DESCRIPTION", "A bot fo the Jardins Efemeros Project.")
     config.set("BOT", "CHANNELS", "935537937028902952")
+    # Results of proposals are posted in the channel they were made in, or in
+    # the RESULTS_CHANNEL of their [GUILD <guild id>] section. This one is
+    # for older proposals, empty for the last of CHANNELS.
+    config.set("BOT", "RESULTS_CHANNEL", "")
+    config.set("BOT", "QUEUE_SIZE", "10000")
+    config.set("BOT", "FLUSH_INTERVAL", "1.0")
+    config.set("BOT", "FETCH_CONCURRENCY", "4")
+    config.set("BOT", "POLL_MIN_INTERVAL", "10")
+    config.set("BOT", "POLL_MAX_INTERVAL", "600")
+    config.set("BOT", "SEND_INTERVAL", "1.0")
+    config.set("BOT", "SEND_COALESCE", "0.25")
+    # 0 lets Discord choose the number of shards. SHARD_IDS lists the shards
+    # this instance runs (separated by ;), empty for all of them. Setting
+    # SHARD_IDS needs SHARD_COUNT set to the total number of shards.
+    config.set("BOT", "SHARD_COUNT", "0")
+    config.set("BOT", "SHARD_IDS", "")
+    # Number of bot processes sharing the database. With more than one they
+    # split the work through leases. An empty INSTANCE_ID uses the host name
+    # and process ID.
+    config.set("BOT", "INSTANCES", "1")
+    config.set("BOT", "INSTANCE_ID", "")
+    config.set("BOT", "LEASE_SECONDS", "30")
     config.add_section("DATABASE")
     config.set("DATABASE", "TYPE", "sqlite")
     config_dir = os.path.dirname(config_file_path)
@@ -28,10 +54,27 @@ def write_default_config(config_file_path):
             "sql/storage.sqlite3"))
     config.set("DATABASE", "USER", "MessageManager")
     config.set("DATABASE", "PASS", "<create a database password here>")
+    config.set("DATABASE", "BATCH_SIZE", "500")
+    config.set("DATABASE", "THREADS", "4")
+    config.set("DATABASE", "POOL_SIZE", "8")
+    config.set("DATABASE", "JOURNAL_MODE", "WAL")
+    config.set("DATABASE", "SYNCHRONOUS", "NORMAL")
+    config.set("DATABASE", "CACHE_SIZE", "-65536")
+    config.set("DATABASE", "MMAP_SIZE", "268435456")
+    config.set("DATABASE", "BUSY_TIMEOUT", "5000")
+    config.set("DATABASE", "PROPOSAL_CACHE_SIZE", "256")
+    config.set("DATABASE", "PROPOSAL_CACHE_TTL", "300")
+    config.add_section("ARCHIVE")
+    config.set("ARCHIVE", "DIR", os.path.join(config_dir, "archive"))
+    config.set("ARCHIVE", "AGE_DAYS", "180")
+    config.set("ARCHIVE", "BATCH_SIZE", "1000")
+    config.set("ARCHIVE", "INTERVAL_HOURS", "6")
+    config.add_section("METRICS")
+    # Every instance running on the same machine needs its own PORT, 0
+    # disables the endpoint.
+    config.set("METRICS", "HOST", "127.0.0.1")
+    config.set("METRICS", "PORT", "9100")
     config.add_section("LOG")
     config.set("LOG", "FILE", os.path.join(config_dir, "log/bot.log"))
     with open(config_file_path, 'w') as config_file:
         config.write(config_file)
-    print(f"Config file {config_file_path} written! Please modify the " \
-            "config file and re-run the program!")
-    exit(0)
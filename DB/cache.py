@@ -0,0 +1,63 @@
+import threading
+import time
+from collections import OrderedDict
+
+class CachedProposal:
+    # The parts of a proposal needed to validate a vote, with the options
+    # already counted.
+    def __init__(self, proposal_id: int, option_count: int, status: int,
+                    guild: int = None):
+        self.proposal_id = proposal_id
+        self.option_count = option_count
+        self.status = status
+        self.guild = guild
+
+class ProposalCache:
+    # Least recently used cache of proposals with a time to live, shared by
+    # the executor threads. Entries are dropped explicitly when a proposal is
+    # created or closed, the TTL only bounds how stale an entry can get if a
+    # proposal is changed some other way.
+    def __init__(self, max_size: int = 256, ttl: float = 300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, proposal_id: int, loader) -> CachedProposal:
+        # loader is called on a miss and returns a CachedProposal, or None if
+        # the proposal does not exist (which is not cached).
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(proposal_id)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(proposal_id)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        proposal = loader(proposal_id)
+        if proposal is not None:
+            self.put(proposal)
+        return proposal
+
+    def put(self, proposal: CachedProposal):
+        with self.lock:
+            self.entries[proposal.proposal_id] = (time.monotonic() + self.ttl,
+                    proposal)
+            self.entries.move_to_end(proposal.proposal_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, proposal_id: int):
+        with self.lock:
+            self.entries.pop(proposal_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits,
+                    "misses": self.misses}
@@ -1,25 +1,40 @@
 # Database imports
-import sqlite3
 from sqlalchemy import create_engine, Column, Integer, ForeignKey, DateTime
-from sqlalchemy import String, func, desc
+from sqlalchemy import String, func, inspect, Index, event
+from sqlalchemy import text, bindparam
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.orm import relationship, sessionmaker, Session
+from sqlalchemy.pool import QueuePool
 from enum import Enum
-# OS imports for paths and sys variables
-import os
-# Configuration file imports.
-from Config import config
+from contextlib import contextmanager
 # Exceptions imports
 from Exceptions import exceptions
-# Imports for discord
-from discord.ext.commands.errors import *
+# Cache for the proposals being voted on
+from DB import cache
+# Proposal text shown in Discord
+from Render import render
 # Misc imports for functionality
-from random import choice as randchoice
-from copy import deepcopy
-from datetime import datetime, date, timedelta
+from datetime import datetime, timedelta
+import logging
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import weakref
+
+log = logging.getLogger(__name__)
 
 BASE = declarative_base()
 
+PROPOSAL_CACHE = cache.ProposalCache()
+
+# engine -> {participant_name: participant_id} of committed participants.
+# Rows are never deleted, so entries never go stale.
+PARTICIPANT_IDS = weakref.WeakKeyDictionary()
+PARTICIPANT_IDS_LOCK = threading.Lock()
+
 class ProposalStatus(Enum):
     popen = 0
     psucceeded = 1
@@ -31,42 +46,50 @@ class Message(BASE):
     message_author = Column(String(255))
     message_content = Column(String(255))
     message_datetime = Column(DateTime) 
+    __table_args__ = (
+        Index('ix_messages_datetime', 'message_datetime'),
+    )
 
 class Proposal(BASE):
     __tablename__ = 'proposals'
     proposal_id = Column(Integer, primary_key=True)
     proposal_author = Column(String(255))
     proposal_text = Column(String(500))
+    # Options joined with '%;%', only set on proposals made before the
+    # proposal_options table. migrate_database moves them into it.
     proposal_options = Column(String(500))
     proposal_expiration= Column(DateTime)
     proposal_decision_status = Column(Integer)
     proposal_decision = Column(String(500))
+    # Where the proposal was made. Its result is announced there and only
+    # members of that guild can vote on it. Empty on older proposals.
+    proposal_guild = Column(Integer)
+    proposal_channel = Column(Integer)
+    __table_args__ = (
+        Index('ix_proposals_status_expiration', 'proposal_decision_status',
+            'proposal_expiration'),
+    )
 
     def __str__(self):
-        self.proposal_expiration_string = self.proposal_expiration.strftime("%d.%m.%Y %H:%M")
-        options = []
-        i = 0
-        for option in self.proposal_options.split('%;%'):
-            i += 1
-            options.append(f"{i}. {option}")
-        options_string = "\n".join(options)
-        return_string = f"Proposta {self.proposal_id}:\nProposta por "\
-                + f"{self.proposal_author}.\n\nTexto:\n{self.proposal_text}\n\n"\
-                + f"Opções:\n{options_string}\n\n"
-        if self.proposal_decision_status == ProposalStatus.popen.value:
-            return_string += "Proposta aberta até: "\
-                    + f"{self.proposal_expiration_string}. Pode votar sobre "\
-                    + f"esta proposta escrevendo !votar "\
-                    + f"{self.proposal_id} opção# "\
-                    + f"Por exemplo, se quisesse votar a favor da primeira "\
-                    + f"opção pode escrever:\n !votar {self.proposal_id} 1"
-        elif self.proposal_decision_status == ProposalStatus.psucceeded.value:
-            return_string += "Proposta aprovada. Opção escholida: "\
-                    + f"{str(self.proposal_decision)}."
-        else:
-            return_string += "Proposta falhada. Houve um empate ou não foram "\
-                    + "recibidos votos."
-        return return_string
+        return render.render_proposal(self.proposal_id,
+                ProposalStatus(self.proposal_decision_status).name,
+                self.proposal_author, self.proposal_text,
+                [(option.option_number, option.option_text)
+                for option in self.options], self.proposal_expiration,
+                self.proposal_decision)
+
+class ProposalOption(BASE):
+    # The options of a proposal, numbered from 1 in the order they were given.
+    __tablename__ = 'proposal_options'
+    option_proposal = Column(Integer, ForeignKey(Proposal.proposal_id),
+            primary_key=True)
+    option_number = Column(Integer, primary_key=True)
+    option_text = Column(String(500))
+
+# Loaded together with the proposals, which are used after their session is
+# closed.
+Proposal.options = relationship(ProposalOption, lazy="selectin",
+        order_by=ProposalOption.option_number)
 
 class Participants(BASE):
     __tablename__ = 'participants'
@@ -76,6 +99,22 @@ class Participants(BASE):
     participant_occupation = Column(String(255))
     participant_site = Column(String(255))
     participant_bio = Column(String(1024))
+    __table_args__ = (
+        Index('ix_participants_name', 'participant_name', unique=True),
+    )
+
+class ParticipantStats(BASE):
+    # Running totals per participant, kept up to date as messages, votes and
+    # proposals are stored so !participacao never scans those tables.
+    # Messages are counted when ingested, archiving does not change them.
+    __tablename__ = 'participant_stats'
+    stats_participant = Column(Integer,
+            ForeignKey(Participants.participant_id), primary_key=True)
+    stats_messages = Column(Integer, default=0)
+    stats_votes = Column(Integer, default=0)
+    stats_proposals = Column(Integer, default=0)
+    stats_first_seen = Column(DateTime)
+    stats_last_seen = Column(DateTime)
 
 class Vote(BASE):
     __tablename__ = 'votes'
@@ -83,20 +122,277 @@ class Vote(BASE):
     vote_author = Column(String(255))
     vote_proposal = Column(Integer, ForeignKey(Proposal.proposal_id))
     vote_choice = Column(Integer)
-    
-def get_database(config, create_db=False):
+    __table_args__ = (
+        # One vote per member and proposal, enforced by the database.
+        Index('ix_votes_proposal_author', 'vote_proposal', 'vote_author',
+            unique=True),
+        Index('ix_votes_author', 'vote_author'),
+    )
+
+class ChannelWatermark(BASE):
+    __tablename__ = 'channel_watermarks'
+    watermark_channel = Column(Integer, primary_key=True)
+    watermark_message = Column(Integer)
+    watermark_datetime = Column(DateTime)
+
+class ArchiveSegment(BASE):
+    # One row per monthly file of archived messages, see Archive/archive.py.
+    __tablename__ = 'archive_segments'
+    segment_month = Column(String(7), primary_key=True)
+    segment_file = Column(String(1024))
+    segment_messages = Column(Integer, default=0)
+    segment_first = Column(DateTime)
+    segment_last = Column(DateTime)
+
+class VoteTally(BASE):
+    # Running count of votes per proposal option, kept up to date by add_vote
+    # and move_vote so results never need a scan of the votes table.
+    __tablename__ = 'vote_tallies'
+    tally_proposal = Column(Integer, ForeignKey(Proposal.proposal_id),
+            primary_key=True)
+    tally_option = Column(Integer, primary_key=True)
+    tally_count = Column(Integer, default=0)
+
+class Lease(BASE):
+    # Named leases shared by the bot instances using the same database, see
+    # Lease/lease.py. A lease belongs to lease_holder until lease_expires.
+    __tablename__ = 'leases'
+    lease_name = Column(String(255), primary_key=True)
+    lease_holder = Column(String(255))
+    lease_expires = Column(DateTime)
+
+class TrackedSession(Session):
+    # Remembers where every session was opened until it is closed, so
+    # sessions that are never closed show up in leaked_sessions() and are
+    # reported when they are garbage collected.
+    _open = {}
+    _lock = threading.Lock()
+    leaked = 0
+
+    def __init__(self, *args, **kwargs):
+        super(TrackedSession, self).__init__(*args, **kwargs)
+        with TrackedSession._lock:
+            TrackedSession._open[id(self)] = (time.monotonic(),
+                    traceback.extract_stack(limit=8)[:-1])
+        weakref.finalize(self, _session_collected, id(self))
+
+    def close(self):
+        with TrackedSession._lock:
+            TrackedSession._open.pop(id(self), None)
+        super(TrackedSession, self).close()
+
+def _session_collected(session_id: int):
+    with TrackedSession._lock:
+        opened = TrackedSession._open.pop(session_id, None)
+        if opened is None:
+            return
+        TrackedSession.leaked += 1
+    log.warning("Database session was never closed. Opened at:\n"\
+        + "".join(traceback.format_list(opened[1])))
+
+def leaked_sessions(older_than: float = 60) -> list:
+    # Returns the stacks of the sessions that have been open for longer than
+    # older_than seconds.
+    now = time.monotonic()
+    with TrackedSession._lock:
+        return ["".join(traceback.format_list(stack)) for opened, stack in \
+                TrackedSession._open.values() if now - opened > older_than]
+
+def engine_profile(config) -> dict:
+    # SQLite tuning read from the [DATABASE] section. WAL lets readers carry
+    # on while the ingestion writer commits, NORMAL synchronous is safe in
+    # WAL mode and saves an fsync per commit.
+    return {
+        "journal_mode": config.get('DATABASE', 'JOURNAL_MODE',
+            fallback='WAL'),
+        "synchronous": config.get('DATABASE', 'SYNCHRONOUS',
+            fallback='NORMAL'),
+        "cache_size": config.getint('DATABASE', 'CACHE_SIZE',
+            fallback=-65536),
+        "mmap_size": config.getint('DATABASE', 'MMAP_SIZE',
+            fallback=268435456),
+        "busy_timeout": config.getint('DATABASE', 'BUSY_TIMEOUT',
+            fallback=5000),
+        "pool_size": config.getint('DATABASE', 'POOL_SIZE', fallback=8),
+    }
+
+def get_database(config, create_db=False, migrate=True):
     file_path = config.get('DATABASE', 'FILE')
     username = config.get('DATABASE', 'USER')
     password = config.get('DATABASE', 'PASS')
     db_type = config.get('DATABASE', 'TYPE')
-    db_name = config.get('DATABASE', 'NAME')
-    engine = create_engine('sqlite:///'+str(file_path).strip())
+    db_name = config.get('DATABASE', 'NAME', fallback=None)
+    profile = engine_profile(config)
+    # Connections are shared by the executor threads, so pysqlite must not
+    # tie them to the thread that opened them.
+    engine = create_engine('sqlite:///'+str(file_path).strip(),
+            poolclass=QueuePool, pool_size=profile["pool_size"],
+            max_overflow=2,
+            connect_args={"check_same_thread": False,
+                "timeout": profile["busy_timeout"] / 1000})
+    event.listen(engine, "connect", _sqlite_pragmas(profile))
+    PROPOSAL_CACHE.max_size = config.getint('DATABASE', 'PROPOSAL_CACHE_SIZE',
+            fallback=256)
+    PROPOSAL_CACHE.ttl = config.getfloat('DATABASE', 'PROPOSAL_CACHE_TTL',
+            fallback=300)
     BASE.metadata.bind = engine
-    if not os.path.exists(file_path):
-        BASE.metadata.create_all(engine)
-    DBSession = sessionmaker(bind=engine)
+    # The bot migrates in the background while it logs in, see
+    # JardinsEfemerosBot.start.
+    if migrate:
+        migrate_database(engine)
+    # Objects are handed back to the event loop after their session is
+    # closed, so keep their attributes loaded after commit.
+    DBSession = sessionmaker(bind=engine, expire_on_commit=False,
+            class_=TrackedSession)
     return DBSession
 
+def _sqlite_pragmas(profile: dict):
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA journal_mode={profile['journal_mode']}")
+        cursor.execute(f"PRAGMA synchronous={profile['synchronous']}")
+        cursor.execute(f"PRAGMA cache_size={int(profile['cache_size'])}")
+        cursor.execute(f"PRAGMA mmap_size={int(profile['mmap_size'])}")
+        cursor.execute(f"PRAGMA busy_timeout={int(profile['busy_timeout'])}")
+        cursor.close()
+    return set_pragmas
+
+@contextmanager
+def session_scope(session_factory):
+    session = session_factory()
+    try:
+        yield session
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+def migrate_database(engine):
+    # Brings existing database files up to the current schema. create_all
+    # only creates the tables that are missing, derived tables are then
+    # filled in from the data already stored.
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    BASE.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    try:
+        rebuild_tallies = VoteTally.__tablename__ not in existing_tables
+        if ProposalOption.__tablename__ not in existing_tables:
+            migrate_proposal_options(session)
+        # Tables that already existed are missing the columns and indexes
+        # added since.
+        for table in BASE.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing_columns = {column["name"] for column in \
+                    inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing_columns:
+                    session.execute(text(f"ALTER TABLE {table.name} ADD "\
+                            + f"COLUMN {column.name} "\
+                            + f"{column.type.compile(engine.dialect)}"))
+            session.commit()
+            existing_indexes = {index["name"] for index in \
+                    inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing_indexes:
+                    continue
+                if index.name == 'ix_votes_proposal_author':
+                    rebuild_tallies |= remove_double_votes(session) > 0
+                index.create(engine)
+        if rebuild_tallies:
+            rebuild_vote_tallies(session)
+        if ParticipantStats.__tablename__ not in existing_tables:
+            rebuild_participant_stats(session)
+        create_search_index(session,
+                rebuild=SEARCH_TABLE not in existing_tables)
+    finally:
+        session.close()
+
+SEARCH_TABLE = 'messages_fts'
+
+SEARCH_SCHEMA = [
+    # External content table: the text lives only in messages, the index is
+    # kept in sync by the triggers below.
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5(
+        message_content, message_author, content='messages',
+        content_rowid='message_id', tokenize='unicode61 remove_diacritics 2')""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON
+        messages BEGIN
+        INSERT INTO {SEARCH_TABLE}(rowid, message_content, message_author)
+        VALUES (new.message_id, new.message_content, new.message_author);
+        END""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON
+        messages BEGIN
+        INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, message_content,
+        message_author) VALUES ('delete', old.message_id, old.message_content,
+        old.message_author);
+        END""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF
+        message_content, message_author ON messages BEGIN
+        INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, message_content,
+        message_author) VALUES ('delete', old.message_id, old.message_content,
+        old.message_author);
+        INSERT INTO {SEARCH_TABLE}(rowid, message_content, message_author)
+        VALUES (new.message_id, new.message_content, new.message_author);
+        END""",
+]
+
+def migrate_proposal_options(session) -> int:
+    # Splits the '%;%' joined options of existing proposals into the
+    # proposal_options table and returns how many proposals were moved.
+    try:
+        proposals = session.query(Proposal.proposal_id,
+                Proposal.proposal_options).filter(
+                Proposal.proposal_options != None).all()
+        session.bulk_insert_mappings(ProposalOption, [{
+                "option_proposal": proposal_id, "option_number": number,
+                "option_text": text} for proposal_id, options in proposals
+                for number, text in enumerate(options.split('%;%'), 1)])
+        session.query(Proposal).update({Proposal.proposal_options: None},
+                synchronize_session=False)
+        session.commit()
+    except Exception as e:
+        log.exception(f"Could not migrate proposal options: {str(e)}.")
+        session.rollback()
+        raise e
+    return len(proposals)
+
+def create_search_index(session, rebuild: bool = False) -> bool:
+    # Creates the full text index over messages, filling it from the
+    # messages already stored when rebuild is set. Returns False if this
+    # SQLite build has no FTS5, in which case searching is unavailable.
+    try:
+        for statement in SEARCH_SCHEMA:
+            session.execute(text(statement))
+        if rebuild:
+            session.execute(text(f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) "\
+                    + "VALUES ('rebuild')"))
+        session.commit()
+        return True
+    except OperationalError as e:
+        session.rollback()
+        log.warning(f"Message search is unavailable: {str(e)}.")
+        return False
+
+def remove_double_votes(session) -> int:
+    # Databases created before votes were unique per member may hold more
+    # than one vote by the same member on a proposal. The first one is kept,
+    # as has_voted would have rejected the others.
+    try:
+        first_votes = session.query(func.min(Vote.vote_id)).group_by(
+                Vote.vote_proposal, Vote.vote_author)
+        removed = session.query(Vote).filter(
+                Vote.vote_id.notin_(first_votes)).delete(
+                synchronize_session=False)
+        session.commit()
+        return removed
+    except Exception as e:
+        log.exception(f"Could not remove double votes: {str(e)}.")
+        session.rollback()
+        raise e
+
 def create_database(engine, file_path):
     try:
         BASE.metadata.bind = engine
@@ -115,6 +411,8 @@ def add_message(session, message_id, message_author, message_time,
         message = Message(message_id=message_id, message_author=message_author,
             message_content=message_content, message_datetime=message_time)
         session.add(message)
+        _change_participants(session, {message_author: _stats_row(
+                messages=1, first_seen=message_time, last_seen=message_time)})
         session.commit()
         return True
     except AssertionError:
@@ -122,66 +420,476 @@ def add_message(session, message_id, message_author, message_time,
     except Exception as e:
         raise e
 
+def add_messages(session, messages, chunk_size: int = 500,
+                commit: bool = True) -> tuple:
+    # Bulk version of add_message. Takes an iterable of dicts keyed by the
+    # Message column names, skips IDs that are already stored, archived (or
+    # repeated in the input) and writes everything in a single transaction.
+    # chunk_size is kept below SQLite's 999 bound variable limit by default.
+    if session is None:
+        raise exceptions.SessionNoneException()
+    inserted = 0
+    skipped = 0
+    chunk = []
+    try:
+        for message in messages:
+            chunk.append(message)
+            if len(chunk) >= chunk_size:
+                added = _add_message_chunk(session, chunk)
+                inserted += added
+                skipped += len(chunk) - added
+                chunk = []
+        if chunk:
+            added = _add_message_chunk(session, chunk)
+            inserted += added
+            skipped += len(chunk) - added
+        if commit:
+            session.commit()
+        return inserted, skipped
+    except Exception as e:
+        log.exception(f"Could not add messages: {str(e)}.")
+        session.rollback()
+        raise e
+
+def _add_message_chunk(session, chunk: list) -> int:
+    message_ids = [message["message_id"] for message in chunk]
+    existing = {row[0] for row in session.query(Message.message_id).filter(
+            Message.message_id.in_(message_ids))}
+    existing.update(_archived_ids(session, chunk))
+    new_messages = []
+    for message in chunk:
+        if message["message_id"] in existing:
+            continue
+        existing.add(message["message_id"])
+        new_messages.append(message)
+    if new_messages:
+        session.bulk_insert_mappings(Message, new_messages)
+        _add_participant_messages(session, new_messages)
+    return len(new_messages)
+
+def _archived_ids(session, messages: list) -> set:
+    # IDs of the messages already moved to an archive segment, so reading a
+    # channel again (or an edit of an old message) does not store and count
+    # them twice. Only the segments of the months in messages are opened.
+    months = {}
+    for message in messages:
+        months.setdefault(message["message_datetime"].strftime("%Y-%m"),
+                []).append(message["message_id"])
+    segments = session.query(ArchiveSegment).filter(
+            ArchiveSegment.segment_month.in_(list(months))).all()
+    archived = set()
+    for segment in segments:
+        if not os.path.exists(segment.segment_file):
+            continue
+        message_ids = months[segment.segment_month]
+        connection = sqlite3.connect(segment.segment_file)
+        try:
+            archived.update(row[0] for row in connection.execute(
+                    "SELECT message_id FROM messages WHERE message_id IN "\
+                    + f"({', '.join('?' * len(message_ids))})", message_ids))
+        finally:
+            connection.close()
+    return archived
+
+def _add_participant_messages(session, messages: list):
+    changes = {}
+    for message in messages:
+        row = changes.get(message["message_author"])
+        if row is None:
+            row = changes[message["message_author"]] = _stats_row(
+                    first_seen=message["message_datetime"],
+                    last_seen=message["message_datetime"])
+        row["stats_messages"] += 1
+        row["stats_first_seen"] = min(row["stats_first_seen"],
+                message["message_datetime"])
+        row["stats_last_seen"] = max(row["stats_last_seen"],
+                message["message_datetime"])
+    _change_participants(session, changes)
+
+def update_messages(session, messages, commit: bool = True) -> int:
+    # Rewrites the content of already stored messages, used for edits.
+    if session is None:
+        raise exceptions.SessionNoneException()
+    updated = 0
+    try:
+        for message in messages:
+            updated += session.query(Message).filter(Message.message_id == \
+                    message["message_id"]).update(
+                    {Message.message_content: message["message_content"]},
+                    synchronize_session=False)
+        if commit:
+            session.commit()
+        return updated
+    except Exception as e:
+        log.exception(f"Could not update messages: {str(e)}.")
+        session.rollback()
+        raise e
+
+def _match_query(terms: list) -> str:
+    # Every term is quoted so user input cannot inject FTS5 syntax. A
+    # trailing * is kept as a prefix search.
+    phrases = []
+    for term in terms:
+        prefix = term.endswith('*')
+        term = term.rstrip('*')
+        if not term:
+            continue
+        phrases.append('"' + term.replace('"', '""') + '"'\
+                + ('*' if prefix else ''))
+    return " ".join(phrases)
+
+def search_messages(
+                    session,
+                    terms: list,
+                    author: str = None,
+                    since: datetime = None,
+                    until: datetime = None,
+                    page: int = 1,
+                    per_page: int = 10
+                ) -> tuple:
+    # Full text search over the archived messages, best matches first.
+    # Without terms the filters alone select the messages, newest first.
+    # Returns the messages of the requested page and whether there are more.
+    if session is None:
+        raise exceptions.SessionNoneException()
+    offset = (max(page, 1) - 1) * per_page
+    match = _match_query(terms)
+    if not match:
+        if author is None and since is None and until is None:
+            return [], False
+        query = session.query(Message)
+        if author is not None:
+            query = query.filter(Message.message_author == author)
+        if since is not None:
+            query = query.filter(Message.message_datetime >= since)
+        if until is not None:
+            query = query.filter(Message.message_datetime < until)
+        messages = query.order_by(Message.message_datetime.desc())\
+                .limit(per_page + 1).offset(offset).all()
+        return messages[:per_page], len(messages) > per_page
+    conditions = [f"{SEARCH_TABLE} MATCH :match"]
+    params = [bindparam("match", match)]
+    if author is not None:
+        conditions.append("messages.message_author = :author")
+        params.append(bindparam("author", author))
+    if since is not None:
+        conditions.append("messages.message_datetime >= :since")
+        params.append(bindparam("since", since, type_=DateTime))
+    if until is not None:
+        conditions.append("messages.message_datetime < :until")
+        params.append(bindparam("until", until, type_=DateTime))
+    statement = text(f"SELECT messages.* FROM {SEARCH_TABLE} JOIN messages "\
+            + f"ON messages.message_id = {SEARCH_TABLE}.rowid WHERE "\
+            + " AND ".join(conditions) + " ORDER BY rank "\
+            + "LIMIT :limit OFFSET :offset").bindparams(*params,
+            bindparam("limit", per_page + 1),
+            bindparam("offset", offset))
+    try:
+        messages = session.query(Message).from_statement(statement).all()
+    except OperationalError as e:
+        if f"no such table: {SEARCH_TABLE}" in str(e):
+            raise exceptions.SearchUnavailableException()
+        raise e
+    return messages[:per_page], len(messages) > per_page
+
 def get_last_message_time(session):
-    last = session.query(Message.message_datetime,
-            func.max(Message.message_datetime))
-    if last.first()[0] is None:
+    # Archived messages count too, in case everything stored has been
+    # archived already.
+    last = session.query(func.max(Message.message_datetime)).scalar()
+    archived = session.query(func.max(ArchiveSegment.segment_last)).scalar()
+    if last is None and archived is None:
         return datetime(2020, 1, 1, 0, 0, 0)
-    else:
-        return last.first()[0]
+    return max(time for time in (last, archived) if time is not None)
+
+def get_channel_watermark(session, channel_id: int) -> int:
+    # Returns the ID of the newest message stored for the channel, or None if
+    # the channel has never been read.
+    if session is None:
+        raise exceptions.SessionNoneException()
+    watermark = session.query(ChannelWatermark).filter(
+            ChannelWatermark.watermark_channel == channel_id).first()
+    if watermark is None:
+        return None
+    return watermark.watermark_message
+
+def set_channel_watermark(session, channel_id: int, message_id: int,
+                            message_time: datetime, commit: bool = True):
+    # Only ever moves the watermark forward.
+    if session is None:
+        raise exceptions.SessionNoneException()
+    try:
+        watermark = session.query(ChannelWatermark).filter(
+                ChannelWatermark.watermark_channel == channel_id).first()
+        if watermark is None:
+            watermark = ChannelWatermark(watermark_channel=channel_id,
+                    watermark_message=message_id,
+                    watermark_datetime=message_time)
+            session.add(watermark)
+        elif message_id > watermark.watermark_message:
+            watermark.watermark_message = message_id
+            watermark.watermark_datetime = message_time
+        if commit:
+            session.commit()
+    except Exception as e:
+        log.exception(f"Could not set channel watermark: {str(e)}.")
+        session.rollback()
+        raise e
 
 def add_vote(
                 session, 
                 proposal_id: int,
                 vote_choice: int,
-                vote_author: str
+                vote_author: str,
+                guild_id: int = None
             ) -> int:
-    proposal = session.query(Proposal).filter(Proposal.proposal_id == \
-                    proposal_id).first()
-    if proposal is None:
+    # Proposals made in another guild do not exist for the voter.
+    proposal = get_cached_proposal(session, proposal_id)
+    if proposal is None or proposal.guild not in (None, guild_id):
         raise exceptions.ProposalDoesNotExistException()
-    if proposal.proposal_decision_status != ProposalStatus.popen.value:
+    if proposal.status != ProposalStatus.popen.value:
         raise exceptions.ProposalClosedException()
-    if has_voted(session, vote_author, proposal):
-        raise exceptions.DoubleVotingException()
-    if vote_choice <= 0 or vote_choice > len(proposal.proposal_options.split('%;%')):
+    if vote_choice <= 0 or vote_choice > proposal.option_count:
         raise exceptions.InvalidVoteException()
     try:
+        # Double votes are rejected by the unique index on
+        # (vote_proposal, vote_author) when the vote is flushed.
         vote = Vote(vote_author=vote_author, vote_proposal=proposal.proposal_id,
                 vote_choice=vote_choice)
         session.add(vote)
+        session.flush()
+        _check_open(session, proposal.proposal_id)
+        _change_tally(session, proposal.proposal_id, vote_choice, 1)
+        now = datetime.utcnow()
+        _change_participants(session, {vote_author: _stats_row(votes=1,
+                first_seen=now, last_seen=now)})
         session.commit()
         return vote.vote_id
+    except IntegrityError:
+        session.rollback()
+        raise exceptions.DoubleVotingException()
+    except exceptions.ProposalClosedException:
+        session.rollback()
+        raise
     except Exception as e:
-        # TODO: Log error.
+        log.exception(f"Could not add vote: {str(e)}.")
+        session.rollback()
         raise e
 
 def move_vote(
                 session, 
                 proposal_id: int,
                 vote_choice: int,
-                vote_author: str
+                vote_author: str,
+                guild_id: int = None
             ) -> int:
-    proposal = session.query(Proposal).filter(Proposal.proposal_id == \
-                    proposal_id).first()
-    if proposal is None:
+    proposal = get_cached_proposal(session, proposal_id)
+    if proposal is None or proposal.guild not in (None, guild_id):
         raise exceptions.ProposalDoesNotExistException()
-    if proposal.proposal_decision_status != ProposalStatus.popen.value:
+    if proposal.status != ProposalStatus.popen.value:
         raise exceptions.ProposalClosedException()
     #if has_voted(session, vote_author, proposal):
     #    raise exceptions.DoubleVotingException()
-    if vote_choice <= 0 or vote_choice > len(proposal.proposal_options.split('%;%')):
+    if vote_choice <= 0 or vote_choice > proposal.option_count:
         raise exceptions.InvalidVoteException()
     try:
         vote = session.query(Vote).filter(Vote.vote_author==vote_author).filter(Vote.vote_proposal==proposal.proposal_id).first()
         if vote is None:
             raise exceptions.VoteDoesntExistException()
+        if vote.vote_choice != vote_choice:
+            _change_tally(session, proposal.proposal_id, vote.vote_choice, -1)
+            _change_tally(session, proposal.proposal_id, vote_choice, 1)
+        _check_open(session, proposal.proposal_id)
         vote.vote_choice = vote_choice
         session.add(vote)
         session.commit()
         return vote.vote_id
+    except (exceptions.VoteDoesntExistException,
+            exceptions.ProposalClosedException):
+        session.rollback()
+        raise
+    except Exception as e:
+        log.exception(f"Could not move vote: {str(e)}.")
+        session.rollback()
+        raise e
+
+def _check_open(session, proposal_id: int):
+    # The cached status can be stale when several instances share the
+    # database and another one closed the proposal. Called once the vote has
+    # been written, when this transaction holds the SQLite write lock, so the
+    # status read here is the latest committed one.
+    status = session.query(Proposal.proposal_decision_status).filter(
+            Proposal.proposal_id == proposal_id).scalar()
+    if status != ProposalStatus.popen.value:
+        PROPOSAL_CACHE.invalidate(proposal_id)
+        raise exceptions.ProposalClosedException()
+
+def _change_tally(session, proposal_id: int, option: int, delta: int):
+    # Done as an UPDATE ... SET count = count + delta so the increment happens
+    # inside the database, in the same transaction as the vote itself.
+    updated = session.query(VoteTally).filter(
+            VoteTally.tally_proposal == proposal_id).filter(
+            VoteTally.tally_option == option).update(
+            {VoteTally.tally_count: VoteTally.tally_count + delta},
+            synchronize_session=False)
+    if updated == 0:
+        session.add(VoteTally(tally_proposal=proposal_id, tally_option=option,
+                tally_count=delta))
+        session.flush()
+
+def get_tally(session, proposal_id: int) -> dict:
+    # Returns {option: votes} for the options that currently have votes.
+    if session is None:
+        raise exceptions.SessionNoneException()
+    tallies = session.query(VoteTally.tally_option,
+            VoteTally.tally_count).filter(
+            VoteTally.tally_proposal == proposal_id).filter(
+            VoteTally.tally_count > 0)
+    return {option: count for option, count in tallies}
+
+def _stats_row(messages: int = 0, votes: int = 0, proposals: int = 0,
+                first_seen: datetime = None, last_seen: datetime = None) -> dict:
+    return {"stats_messages": messages, "stats_votes": votes,
+            "stats_proposals": proposals, "stats_first_seen": first_seen,
+            "stats_last_seen": last_seen}
+
+def _participant_ids(session, names: list) -> dict:
+    # Returns {name: participant_id}, adding the participants not seen before.
+    with PARTICIPANT_IDS_LOCK:
+        known = PARTICIPANT_IDS.get(session.get_bind(), {})
+        ids = {name: known[name] for name in names if name in known}
+    missing = [name for name in names if name not in ids]
+    found = {}
+    for start in range(0, len(missing), 500):
+        chunk = missing[start:start + 500]
+        session.execute(Participants.__table__.insert().prefix_with(
+                "OR IGNORE"), [{"participant_name": name} for name in chunk])
+        found.update(session.query(Participants.participant_name,
+                Participants.participant_id).filter(
+                Participants.participant_name.in_(chunk)))
+    if found:
+        # Only remembered once committed, see _remember_participants.
+        session.info.setdefault("participant_ids", {}).update(found)
+        ids.update(found)
+    return ids
+
+@event.listens_for(Session, "after_commit")
+def _remember_participants(session):
+    found = session.info.pop("participant_ids", None)
+    if found:
+        with PARTICIPANT_IDS_LOCK:
+            PARTICIPANT_IDS.setdefault(session.get_bind(), {}).update(found)
+
+@event.listens_for(Session, "after_rollback")
+def _forget_participants(session):
+    session.info.pop("participant_ids", None)
+
+# Built once, it runs on every vote and message batch. min() and max() of
+# SQLite return NULL if either side is NULL, hence the coalesce.
+PARTICIPANT_STATS_UPSERT = text("""INSERT INTO participant_stats
+        (stats_participant, stats_messages, stats_votes, stats_proposals,
+        stats_first_seen, stats_last_seen) VALUES (:stats_participant,
+        :stats_messages, :stats_votes, :stats_proposals, :stats_first_seen,
+        :stats_last_seen) ON CONFLICT(stats_participant) DO UPDATE SET
+        stats_messages = stats_messages + excluded.stats_messages,
+        stats_votes = stats_votes + excluded.stats_votes,
+        stats_proposals = stats_proposals + excluded.stats_proposals,
+        stats_first_seen = coalesce(min(stats_first_seen,
+            excluded.stats_first_seen), stats_first_seen,
+            excluded.stats_first_seen),
+        stats_last_seen = coalesce(max(stats_last_seen,
+            excluded.stats_last_seen), stats_last_seen,
+            excluded.stats_last_seen)""").bindparams(
+        bindparam("stats_first_seen", type_=DateTime),
+        bindparam("stats_last_seen", type_=DateTime))
+
+def _change_participants(session, changes: dict):
+    # Adds {name: _stats_row(...)} to the participant totals. Like the vote
+    # tallies the counts are incremented inside the database, in the
+    # transaction of the change itself.
+    if not changes:
+        return
+    ids = _participant_ids(session, list(changes))
+    session.execute(PARTICIPANT_STATS_UPSERT, [dict(row,
+            stats_participant=ids[name]) for name, row in changes.items()])
+
+def rebuild_participant_stats(session):
+    # Recounts every participant from the messages, votes and proposals
+    # tables. Only needed when migrating a database that already holds them,
+    # messages that were archived before are not counted.
+    try:
+        session.query(ParticipantStats).delete(synchronize_session=False)
+        changes = {}
+        for author, count, first, last in session.query(
+                Message.message_author, func.count(Message.message_id),
+                func.min(Message.message_datetime),
+                func.max(Message.message_datetime)).group_by(
+                Message.message_author):
+            changes[author] = _stats_row(messages=count, first_seen=first,
+                    last_seen=last)
+        for author, count in session.query(Vote.vote_author,
+                func.count(Vote.vote_id)).group_by(Vote.vote_author):
+            changes.setdefault(author, _stats_row())["stats_votes"] = count
+        for author, count in session.query(Proposal.proposal_author,
+                func.count(Proposal.proposal_id)).group_by(
+                Proposal.proposal_author):
+            changes.setdefault(author,
+                    _stats_row())["stats_proposals"] = count
+        changes.pop(None, None)
+        _change_participants(session, changes)
+        session.commit()
     except Exception as e:
-        # TODO: Log error.
+        log.exception(f"Could not rebuild participant stats: {str(e)}.")
+        session.rollback()
+        raise e
+
+def get_proposal_panel(session, proposal_id: int) -> tuple:
+    # Returns (proposal, {option: votes}, number of participants) for
+    # !painel, or (None, {}, 0) if the proposal does not exist.
+    if session is None:
+        raise exceptions.SessionNoneException()
+    proposal = get_proposal(session, proposal_id)
+    if proposal is None:
+        return None, {}, 0
+    return proposal, get_tally(session, proposal_id), session.query(
+            func.count(Participants.participant_id)).scalar()
+
+def get_participation(session, participant_name: str,
+                        recent: int = 5) -> tuple:
+    # Returns (ParticipantStats or None, number of proposals, latest votes)
+    # for !participacao. The latest votes are (proposal_id, proposal_text,
+    # vote_choice, option_text) tuples, newest first.
+    if session is None:
+        raise exceptions.SessionNoneException()
+    stats = session.query(ParticipantStats).join(Participants,
+            Participants.participant_id == \
+            ParticipantStats.stats_participant).filter(
+            Participants.participant_name == participant_name).first()
+    proposals = session.query(func.count(Proposal.proposal_id)).scalar()
+    votes = session.query(Vote.vote_proposal, Proposal.proposal_text,
+            Vote.vote_choice, ProposalOption.option_text).join(Proposal,
+            Proposal.proposal_id == Vote.vote_proposal).outerjoin(
+            ProposalOption, (ProposalOption.option_proposal == \
+            Vote.vote_proposal) & (ProposalOption.option_number == \
+            Vote.vote_choice)).filter(Vote.vote_author == \
+            participant_name).order_by(Vote.vote_id.desc()).limit(
+            recent).all()
+    return stats, proposals, votes
+
+def rebuild_vote_tallies(session):
+    # Recounts every tally from the votes table. Only needed when migrating
+    # a database that already holds votes.
+    try:
+        session.query(VoteTally).delete(synchronize_session=False)
+        counts = session.query(Vote.vote_proposal, Vote.vote_choice,
+                func.count(Vote.vote_id)).group_by(Vote.vote_proposal,
+                Vote.vote_choice)
+        session.bulk_insert_mappings(VoteTally, [{"tally_proposal": proposal,
+                "tally_option": option, "tally_count": count}
+                for proposal, option, count in counts])
+        session.commit()
+    except Exception as e:
+        log.exception(f"Could not rebuild vote tallies: {str(e)}.")
+        session.rollback()
         raise e
 
 def add_proposal(
@@ -189,20 +897,28 @@ def add_proposal(
                     proposal_text: str,
                     proposal_author: str, 
                     proposal_choices: list,
-                    proposal_days: int                
+                    proposal_days: int,
+                    guild_id: int = None,
+                    channel_id: int = None
                 ) -> Proposal:
     if session is None:
         raise exceptions.SessionNoneException()
-    #print(proposal_choices)
-    #proposal_options = "%;%".join(proposal_choices)
     proposal_expires = datetime.now() + timedelta(days=proposal_days)
     proposal = Proposal(proposal_author=proposal_author,
                         proposal_text=proposal_text,
-                        proposal_options=proposal_choices,
                         proposal_expiration=proposal_expires,
-                        proposal_decision_status=ProposalStatus.popen.value)
+                        proposal_decision_status=ProposalStatus.popen.value,
+                        proposal_guild=guild_id,
+                        proposal_channel=channel_id,
+                        options=[ProposalOption(option_number=number,
+                                option_text=text) for number, text in \
+                                enumerate(proposal_choices, 1)])
     session.add(proposal)
+    now = datetime.utcnow()
+    _change_participants(session, {proposal_author: _stats_row(proposals=1,
+            first_seen=now, last_seen=now)})
     session.commit()
+    PROPOSAL_CACHE.invalidate(proposal.proposal_id)
     return proposal
 
 def get_proposal(session, proposal_id: int) -> Proposal:
@@ -212,6 +928,29 @@ def get_proposal(session, proposal_id: int) -> Proposal:
             proposal_id).first()
     return proposal
 
+def get_open_proposal_deadlines(session) -> list:
+    # Returns (proposal_id, proposal_expiration) for every open proposal.
+    if session is None:
+        raise exceptions.SessionNoneException()
+    return session.query(Proposal.proposal_id,
+            Proposal.proposal_expiration).filter(
+            Proposal.proposal_decision_status == \
+            ProposalStatus.popen.value).all()
+
+def get_cached_proposal(session, proposal_id: int) -> cache.CachedProposal:
+    # Read-through lookup of the proposal status and option count, used to
+    # validate votes without loading and re-parsing the proposal every time.
+    if session is None:
+        raise exceptions.SessionNoneException()
+    def load(proposal_id):
+        proposal = get_proposal(session, proposal_id)
+        if proposal is None:
+            return None
+        return cache.CachedProposal(proposal.proposal_id,
+                len(proposal.options),
+                proposal.proposal_decision_status, proposal.proposal_guild)
+    return PROPOSAL_CACHE.get(proposal_id, load)
+
 def get_votes(session, proposal: Proposal) -> list:
     if session is None:
         # Raise relevant exception
@@ -223,7 +962,7 @@ def get_votes(session, proposal: Proposal) -> list:
         votes = session.query(Vote).filter(Vote.vote_proposal==proposal).all()
         return votes
     except Exception as e:
-        # TODO: Log error.
+        log.exception(f"Could not get votes: {str(e)}.")
         raise e
 
 def has_voted(session, vote_author: str, proposal: Proposal) -> bool:
@@ -232,30 +971,82 @@ def has_voted(session, vote_author: str, proposal: Proposal) -> bool:
         return True
     return False
 
+def acquire_leases(session, lease_names: list, holder: str,
+                    seconds: float) -> set:
+    # Takes every lease in lease_names that is free, expired or already held
+    # by holder for another seconds, and returns the names holder now has.
+    # SQLite runs one write transaction at a time, so two instances can never
+    # both take the same expired lease.
+    if not lease_names:
+        return set()
+    now = datetime.utcnow()
+    expires = now + timedelta(seconds=seconds)
+    try:
+        session.execute(Lease.__table__.insert().prefix_with("OR IGNORE"),
+                [{"lease_name": name, "lease_holder": holder,
+                "lease_expires": expires} for name in lease_names])
+        session.query(Lease).filter(Lease.lease_name.in_(lease_names)).filter(
+                (Lease.lease_holder == holder) | \
+                (Lease.lease_expires < now)).update({
+                Lease.lease_holder: holder, Lease.lease_expires: expires},
+                synchronize_session=False)
+        held = {name for name, in session.query(Lease.lease_name).filter(
+                Lease.lease_name.in_(lease_names)).filter(
+                Lease.lease_holder == holder)}
+        session.commit()
+    except Exception as e:
+        log.exception(f"Could not acquire leases: {str(e)}.")
+        session.rollback()
+        raise e
+    return held
+
+def release_leases(session, holder: str) -> int:
+    # Gives up every lease of holder so other instances can take them over
+    # straight away instead of waiting for them to expire.
+    try:
+        released = session.query(Lease).filter(Lease.lease_holder == \
+                holder).delete(synchronize_session=False)
+        session.commit()
+    except Exception as e:
+        log.exception(f"Could not release leases: {str(e)}.")
+        session.rollback()
+        raise e
+    return released
+
 def update_expiring_proposals(session):
     proposals = session.query(Proposal).filter(Proposal.proposal_expiration <= datetime.now()).filter(Proposal.proposal_decision_status == ProposalStatus.popen.value).all()
+    if not proposals:
+        return proposals
+    vote_options = {}
+    tallies = session.query(VoteTally.tally_proposal, VoteTally.tally_option,
+            VoteTally.tally_count).filter(VoteTally.tally_proposal.in_(
+            [proposal.proposal_id for proposal in proposals])).filter(
+            VoteTally.tally_count > 0)
+    for proposal_id, option, count in tallies:
+        vote_options.setdefault(proposal_id, {})[option] = count
     for proposal in proposals:
-        vote_options = {}
-        votes = session.query(Vote).filter(Vote.vote_proposal==proposal.proposal_id).all()
-        for vote in votes:
-            try:
-                vote_options[vote.vote_choice] += 1
-            except KeyError:
-                vote_options[vote.vote_choice] = 1
-        max_votes = 0
-        winning_option = []
-        for option in vote_options:
-            if vote_options[option] > max_votes:
-                max_votes = vote_options[option]
-                winning_option.clear()
-                winning_option.append(option)
-            elif vote_options[option] == max_votes:
-                winning_option.append(option)
+        winning_option = _winning_options(
+                vote_options.get(proposal.proposal_id, {}))
         if len(winning_option) == 1:
             proposal.proposal_decision_status = ProposalStatus.psucceeded.value
             proposal.proposal_decision = winning_option[0]
         else:
             proposal.proposal_decision_status = ProposalStatus.pfailed.value
             proposal.proposal_decision = None
-        session.commit()
+    session.commit()
+    for proposal in proposals:
+        PROPOSAL_CACHE.invalidate(proposal.proposal_id)
+        render.RENDER_CACHE.invalidate(proposal.proposal_id)
     return proposals
+
+def _winning_options(vote_options: dict) -> list:
+    max_votes = 0
+    winning_option = []
+    for option in vote_options:
+        if vote_options[option] > max_votes:
+            max_votes = vote_options[option]
+            winning_option.clear()
+            winning_option.append(option)
+        elif vote_options[option] == max_votes:
+            winning_option.append(option)
+    return winning_option
@@ -0,0 +1,68 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from DB import db
+from Metrics import metrics
+
+class DatabaseExecutor:
+    # Runs the blocking DB.db functions on threads so a slow commit or a lock
+    # wait never stalls the event loop (and with it the gateway heartbeat).
+    # SQLite allows a single writer, so writes are queued on one thread while
+    # reads share a pool and, in WAL mode, never wait for the writer. Every
+    # call gets its own session from db.session_scope, which is passed as the
+    # first argument, the same way the db functions expect.
+    def __init__(self, session_factory, threads: int = 4):
+        self.session_factory = session_factory
+        self.writer = ThreadPoolExecutor(max_workers=1,
+                thread_name_prefix="database-writer")
+        self.readers = ThreadPoolExecutor(max_workers=threads,
+                thread_name_prefix="database-reader")
+        self.lock = threading.Lock()
+        # Calls submitted but not yet picked up by a thread.
+        self.queue_depth = 0
+        self.calls = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    async def run(self, function, *args, **kwargs):
+        # For anything that writes.
+        return await self._submit(self.writer, "writer", function, args,
+                kwargs)
+
+    async def read(self, function, *args, **kwargs):
+        return await self._submit(self.readers, "reader", function, args,
+                kwargs)
+
+    async def _submit(self, pool, pool_name: str, function, args: tuple,
+                        kwargs: dict):
+        loop = asyncio.get_event_loop()
+        with self.lock:
+            self.queue_depth += 1
+        return await loop.run_in_executor(pool, self._call, pool_name,
+                time.perf_counter(), function, args, kwargs)
+
+    def _call(self, pool_name: str, submitted: float, function, args: tuple,
+                kwargs: dict):
+        wait = time.perf_counter() - submitted
+        with self.lock:
+            self.queue_depth -= 1
+            self.calls += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+        metrics.DB_WAIT_SECONDS.observe(wait, pool=pool_name)
+        with metrics.DB_CALL_SECONDS.time(function=function.__name__):
+            with db.session_scope(self.session_factory) as session:
+                return function(session, *args, **kwargs)
+
+    def stats(self) -> dict:
+        with self.lock:
+            average_wait = self.total_wait / self.calls if self.calls else 0.0
+            return {"queue_depth": self.queue_depth, "calls": self.calls,
+                    "average_wait": average_wait, "max_wait": self.max_wait,
+                    "leaked_sessions": db.TrackedSession.leaked,
+                    "long_open_sessions": len(db.leaked_sessions())}
+
+    def shutdown(self):
+        self.writer.shutdown(wait=True)
+        self.readers.shutdown(wait=True)
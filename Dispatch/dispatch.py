@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import discord
+from Ingest.ingest import retry_after
+from Metrics import metrics
+
+log = logging.getLogger(__name__)
+
+# Discord rejects messages longer than this.
+MAX_LENGTH = 2000
+
+def split_message(content: str, limit: int = MAX_LENGTH) -> list:
+    # Splits on line breaks where possible, cutting lines only when a single
+    # line is longer than the limit.
+    parts = []
+    current = ""
+    for line in content.split("\n"):
+        while len(line) > limit:
+            if current:
+                parts.append(current)
+                current = ""
+            parts.append(line[:limit])
+            line = line[limit:]
+        if not current:
+            current = line
+        elif len(current) + 1 + len(line) <= limit:
+            current += "\n" + line
+        else:
+            parts.append(current)
+            current = line
+    if current or not parts:
+        parts.append(current)
+    return parts
+
+def coalesce(items: list, limit: int = MAX_LENGTH) -> list:
+    # Packs the queued (content, future) items into as few messages as
+    # possible. Returns (message, futures) pairs, every future is attached to
+    # the message that completes its content.
+    chunks = []
+    current = ""
+    futures = []
+    for content, future in items:
+        for part in split_message(content, limit):
+            if not current:
+                current = part
+            elif len(current) + 2 + len(part) <= limit:
+                current += "\n\n" + part
+            else:
+                chunks.append((current, futures))
+                current = part
+                futures = []
+        futures.append(future)
+    if current or futures:
+        chunks.append((current, futures))
+    return chunks
+
+class Dispatcher:
+    # Sends outgoing messages through one queue and one task per channel, so
+    # command handlers and announcements never wait on the REST API. Messages
+    # queued within coalesce_window of each other are merged into as few
+    # Discord messages as fit in 2000 characters, sends to a channel are
+    # spaced by interval seconds, and rate limited or failed sends are
+    # retried with backoff.
+    def __init__(self, interval: float = 1.0, coalesce_window: float = 0.25,
+                    max_retries: int = 5):
+        self.interval = interval
+        self.coalesce_window = coalesce_window
+        self.max_retries = max_retries
+        self.queues = {}
+        self.tasks = {}
+        self.pending = set()
+
+    def send(self, channel, content: str) -> asyncio.Future:
+        # Queues content for the channel. The returned future resolves to
+        # True once it was sent, or False if sending failed for good; it
+        # does not need to be awaited.
+        future = asyncio.get_event_loop().create_future()
+        self.pending.add(future)
+        future.add_done_callback(self.pending.discard)
+        queue = self.queues.get(channel.id)
+        if queue is None:
+            queue = self.queues[channel.id] = asyncio.Queue()
+            self.tasks[channel.id] = asyncio.ensure_future(
+                    self._run(channel, queue))
+        queue.put_nowait((content, future))
+        return future
+
+    def queue_depth(self) -> int:
+        return sum(queue.qsize() for queue in self.queues.values())
+
+    async def _run(self, channel, queue: asyncio.Queue):
+        while True:
+            items = [await queue.get()]
+            await asyncio.sleep(self.coalesce_window)
+            while not queue.empty():
+                items.append(queue.get_nowait())
+            for content, futures in coalesce(items):
+                sent = await self._deliver(channel, content)
+                for future in futures:
+                    if not future.done():
+                        future.set_result(sent)
+                await asyncio.sleep(self.interval)
+
+    async def _deliver(self, channel, content: str) -> bool:
+        delay = self.interval
+        for attempt in range(self.max_retries):
+            try:
+                await channel.send(content)
+                metrics.MESSAGES_SENT.inc(result="sent")
+                return True
+            except discord.HTTPException as e:
+                # Retry rate limits and server errors, anything else (missing
+                # permissions, bad request) would fail again.
+                if e.status != 429 and e.status < 500:
+                    log.error(f"Could not send to channel {channel.id}: "\
+                        + f"{str(e)}.", extra={"channel": channel.id})
+                    break
+                metrics.MESSAGES_SENT.inc(result="retried")
+                await asyncio.sleep(retry_after(e, delay))
+                delay *= 2
+            except Exception as e:
+                log.exception(f"Could not send to channel {channel.id}: "\
+                    + f"{str(e)}.", extra={"channel": channel.id})
+                break
+        metrics.MESSAGES_SENT.inc(result="failed")
+        return False
+
+    async def close(self, timeout: float = 10):
+        # Gives the queued messages up to timeout seconds to be sent before
+        # the channel tasks are stopped. Whatever is left resolves to False.
+        if self.pending:
+            await asyncio.wait(list(self.pending), timeout=timeout)
+        for task in self.tasks.values():
+            task.cancel()
+        for future in list(self.pending):
+            if not future.done():
+                future.set_result(False)
@@ -18,3 +18,12 @@ class InvalidVoteException(Exception):
 
 class VoteDoesntExistException(Exception):
     pass
+
+class SearchUnavailableException(Exception):
+    pass
+
+class ConfigCreatedException(Exception):
+    pass
+
+class InvalidConfigException(Exception):
+    pass
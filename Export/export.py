@@ -0,0 +1,231 @@
+#!/usr/bin/python3
+# Streams messages, proposals, their options and votes out of the database as
+# CSV, JSON Lines or Parquet.
+#
+#   python3 -m Export.export --table messages --format jsonl \
+#       --since 2022-01-01 --output messages.jsonl
+import argparse
+import csv
+import json
+import sys
+from datetime import datetime
+from sqlalchemy import DateTime, Integer
+from Config import config
+from DB import db
+from Archive import archive
+from Exceptions import exceptions
+
+TABLES = {
+    "messages": db.Message,
+    "proposals": db.Proposal,
+    "votes": db.Vote,
+    "options": db.ProposalOption,
+}
+
+FORMATS = ("csv", "jsonl", "parquet")
+
+# The tables that can be filtered by date and by proposal.
+DATED_TABLES = ("messages", "proposals")
+PROPOSAL_TABLES = ("proposals", "votes", "options")
+
+# Rows are fetched from the cursor this many at a time, so memory use does not
+# depend on the size of the table.
+BATCH_SIZE = 1000
+
+def export_columns(table: str) -> list:
+    return [column.name for column in TABLES[table].__table__.columns]
+
+def query_rows(session, table: str, since: datetime = None,
+                until: datetime = None, proposal_id: int = None):
+    # Plain column tuples rather than ORM objects, nothing is kept in the
+    # session while streaming. In WAL mode this read never blocks the writer.
+    model = TABLES[table]
+    query = session.query(*model.__table__.columns)
+    if table == "messages":
+        if since is not None:
+            query = query.filter(db.Message.message_datetime >= since)
+        if until is not None:
+            query = query.filter(db.Message.message_datetime < until)
+        query = query.order_by(db.Message.message_datetime)
+    elif table == "proposals":
+        if proposal_id is not None:
+            query = query.filter(db.Proposal.proposal_id == proposal_id)
+        if since is not None:
+            query = query.filter(db.Proposal.proposal_expiration >= since)
+        if until is not None:
+            query = query.filter(db.Proposal.proposal_expiration < until)
+        query = query.order_by(db.Proposal.proposal_id)
+    elif table == "votes":
+        if proposal_id is not None:
+            query = query.filter(db.Vote.vote_proposal == proposal_id)
+        query = query.order_by(db.Vote.vote_id)
+    elif table == "options":
+        if proposal_id is not None:
+            query = query.filter(db.ProposalOption.option_proposal == \
+                    proposal_id)
+        query = query.order_by(db.ProposalOption.option_proposal,
+                db.ProposalOption.option_number)
+    return query.execution_options(stream_results=True).yield_per(BATCH_SIZE)
+
+def iter_rows(session, table: str, since: datetime = None,
+                until: datetime = None, proposal_id: int = None,
+                include_archive: bool = False):
+    columns = export_columns(table)
+    if table == "messages" and include_archive:
+        for message in archive.iter_archived_messages(session, since, until):
+            yield tuple(getattr(message, column) for column in columns)
+    for row in query_rows(session, table, since, until, proposal_id):
+        yield tuple(row)
+
+def _serialize(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+def write_csv(rows, columns: list, output) -> int:
+    writer = csv.writer(output)
+    writer.writerow(columns)
+    count = 0
+    for row in rows:
+        writer.writerow([_serialize(value) for value in row])
+        count += 1
+    return count
+
+def write_jsonl(rows, columns: list, output) -> int:
+    count = 0
+    for row in rows:
+        output.write(json.dumps(dict(zip(columns, map(_serialize, row))),
+                ensure_ascii=False) + "\n")
+        count += 1
+    return count
+
+def parquet_schema(pyarrow, table: str):
+    # Built once from the column types. Inferred from each batch instead, a
+    # column that is empty in one batch would be null there and typed in the
+    # next, which the writer rejects.
+    fields = []
+    for column in TABLES[table].__table__.columns:
+        if isinstance(column.type, Integer):
+            column_type = pyarrow.int64()
+        elif isinstance(column.type, DateTime):
+            column_type = pyarrow.timestamp("us")
+        else:
+            column_type = pyarrow.string()
+        fields.append(pyarrow.field(column.name, column_type))
+    return pyarrow.schema(fields)
+
+def write_parquet(rows, table: str, path: str) -> int:
+    # pyarrow is only needed for this format.
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("Parquet export needs pyarrow, install it with "\
+            + "pip install pyarrow.")
+    schema = parquet_schema(pyarrow, table)
+    count = 0
+    writer = None
+    batch = []
+    try:
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= BATCH_SIZE:
+                writer = _write_parquet_batch(pyarrow, writer, batch, schema,
+                        path)
+                count += len(batch)
+                batch = []
+        if batch or writer is None:
+            writer = _write_parquet_batch(pyarrow, writer, batch, schema,
+                    path)
+            count += len(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+    return count
+
+def _write_parquet_batch(pyarrow, writer, batch: list, schema, path: str):
+    arrays = []
+    for i, field in enumerate(schema):
+        values = [row[i] for row in batch]
+        if field.type == pyarrow.string():
+            # SQLite hands back whatever was stored, proposal_decision holds
+            # the number of the chosen option.
+            values = [None if value is None else str(value)
+                    for value in values]
+        arrays.append(pyarrow.array(values, type=field.type))
+    table = pyarrow.Table.from_arrays(arrays, schema=schema)
+    if writer is None:
+        writer = pyarrow.parquet.ParquetWriter(path, schema)
+    writer.write_table(table)
+    return writer
+
+def export(session, table: str, export_format: str, path: str,
+            since: datetime = None, until: datetime = None,
+            proposal_id: int = None, include_archive: bool = False) -> int:
+    # Writes the table to path and returns the number of rows written. Has
+    # the (session, ...) signature of the db functions so it can run on the
+    # database executor.
+    if table not in TABLES:
+        raise ValueError(f"Unknown table {table}.")
+    if export_format not in FORMATS:
+        raise ValueError(f"Unknown format {export_format}.")
+    if (since is not None or until is not None) and table not in DATED_TABLES:
+        raise ValueError(f"Table {table} has no dates.")
+    if proposal_id is not None and table not in PROPOSAL_TABLES:
+        raise ValueError(f"Table {table} has no proposals.")
+    columns = export_columns(table)
+    rows = iter_rows(session, table, since, until, proposal_id,
+            include_archive)
+    if export_format == "parquet":
+        return write_parquet(rows, table, path)
+    if path == "-":
+        output = sys.stdout
+    else:
+        output = open(path, 'w', newline='', encoding='utf-8')
+    try:
+        if export_format == "csv":
+            return write_csv(rows, columns, output)
+        return write_jsonl(rows, columns, output)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+def parse_date(text: str) -> datetime:
+    return datetime.strptime(text, "%Y-%m-%d")
+
+def main():
+    parser = argparse.ArgumentParser(description="Export messages, "\
+            + "proposals, proposal options or votes.")
+    parser.add_argument("--config", default=None,
+            help="bot config file (default ~/.JardinsEfemerosBot/bot.conf)")
+    parser.add_argument("--table", choices=sorted(TABLES), required=True)
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument("--output", default="-",
+            help="output file, - for stdout (not for parquet)")
+    parser.add_argument("--since", type=parse_date, default=None,
+            help="AAAA-MM-DD")
+    parser.add_argument("--until", type=parse_date, default=None,
+            help="AAAA-MM-DD")
+    parser.add_argument("--proposal", type=int, default=None)
+    parser.add_argument("--archive", action="store_true",
+            help="include archived messages")
+    args = parser.parse_args()
+    if args.format == "parquet" and args.output == "-":
+        parser.error("parquet needs an --output file")
+    if (args.since or args.until) and args.table not in DATED_TABLES:
+        parser.error("--since and --until only apply to "\
+                + f"{', '.join(DATED_TABLES)}")
+    if args.proposal is not None and args.table not in PROPOSAL_TABLES:
+        parser.error("--proposal only applies to "\
+                + f"{', '.join(PROPOSAL_TABLES)}")
+    try:
+        options = config.read_config(args.config)
+    except exceptions.ConfigCreatedException as e:
+        parser.exit(1, f"{str(e)}\n")
+    with db.session_scope(db.get_database(options)) as session:
+        count = export(session, args.table, args.format, args.output,
+                args.since, args.until, args.proposal, args.archive)
+    print(f"Exported {count} rows.", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+import asyncio
+import logging
+import time
+import discord
+from DB import db
+from Lease import lease
+from Metrics import metrics
+
+log = logging.getLogger(__name__)
+
+def message_record(message) -> dict:
+    return {"message_id": message.id,
+            "message_author": message.author.display_name,
+            "message_datetime": message.created_at,
+            "message_content": message.clean_content}
+
+async def backfill_channel(database, channel, page_size: int = 500) -> tuple:
+    # Streams the channel history from its watermark onwards, oldest first.
+    # Every page is stored together with the new watermark in one transaction,
+    # so an interrupted backfill resumes from the last stored page and memory
+    # never grows beyond page_size messages.
+    # Channels without a watermark are read from the beginning, the messages
+    # already stored are skipped by add_messages.
+    last_id = await database.read(db.get_channel_watermark, channel.id)
+    after = None if last_id is None else discord.Object(id=last_id)
+    inserted = 0
+    skipped = 0
+    page = []
+    async for message in channel.history(limit=None, after=after,
+                                            oldest_first=True):
+        page.append(message_record(message))
+        if len(page) >= page_size:
+            added, dropped = await database.run(_store_page, channel.id,
+                    page, page_size)
+            inserted += added
+            skipped += dropped
+            page = []
+    if page:
+        added, dropped = await database.run(_store_page, channel.id, page,
+                page_size)
+        inserted += added
+        skipped += dropped
+    return inserted, skipped
+
+def _store_page(session, channel_id: int, page: list, chunk_size: int) -> tuple:
+    inserted, skipped = db.add_messages(session, page, chunk_size,
+            commit=False)
+    newest = max(page, key=lambda record: record["message_id"])
+    db.set_channel_watermark(session, channel_id, newest["message_id"],
+            newest["message_datetime"])
+    metrics.MESSAGES_INGESTED.inc(inserted, source="history")
+    metrics.message_stored(newest["message_datetime"])
+    return inserted, skipped
+
+class ChannelStats:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.fetches = 0
+        self.messages = 0
+        self.rate_limited = 0
+        self.last_latency = None
+        self.last_fetch = None
+
+class ChannelScheduler:
+    # Reads the history of every configured channel concurrently. At most
+    # concurrency fetches run at once, so the shared global rate limit is not
+    # exhausted. The first pass is the startup backfill. After that each
+    # channel is re-read to pick up anything the gateway missed, at an
+    # interval that halves when new messages turn up and doubles while the
+    # channel stays quiet. If leases is given, a channel is only read while
+    # this instance holds its lease.
+    def __init__(self, bot, writer, concurrency: int = 4,
+                    page_size: int = 500, min_interval: float = 10,
+                    max_interval: float = 600, leases=None):
+        self.bot = bot
+        self.writer = writer
+        self.leases = leases
+        self.page_size = page_size
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.stats = {}
+
+    async def run(self, channel_ids: list):
+        await asyncio.gather(*[self.poll_channel(int(channel_id))
+                for channel_id in channel_ids])
+
+    async def poll_channel(self, channel_id: int):
+        stats = self.stats[channel_id] = ChannelStats(self.min_interval)
+        while not self.bot.is_closed():
+            channel = self.bot.get_channel(channel_id)
+            if channel is None:
+                log.warning(f"Channel {channel_id} not found, it does not "\
+                    + "exist or is not on the shards of this instance.",
+                    extra={"channel": channel_id})
+                return
+            if self.leases is not None:
+                lease_name = lease.channel_lease(channel_id)
+                self.leases.want(lease_name)
+                if not self.leases.holds(lease_name):
+                    # Another instance reads this channel. Once the lease is
+                    # taken over, the backfill continues from its watermark.
+                    await asyncio.sleep(self.min_interval)
+                    continue
+            try:
+                inserted = await self.fetch(channel, stats)
+            except discord.HTTPException as e:
+                if e.status != 429:
+                    log.error(f"Could not read channel {channel_id}: "\
+                        + f"{str(e)}.", extra={"channel": channel_id})
+                    await asyncio.sleep(stats.interval)
+                    continue
+                # discord.py already retries rate limited requests, this is
+                # only reached once it gives up, so wait out the bucket.
+                stats.rate_limited += 1
+                await asyncio.sleep(retry_after(e, stats.interval))
+                continue
+            except Exception as e:
+                log.exception(f"Could not read channel {channel_id}: "\
+                    + f"{str(e)}.", extra={"channel": channel_id})
+                await asyncio.sleep(stats.interval)
+                continue
+            if inserted > 0:
+                stats.interval = max(self.min_interval, stats.interval / 2)
+            else:
+                stats.interval = min(self.max_interval, stats.interval * 2)
+            await asyncio.sleep(stats.interval)
+
+    async def fetch(self, channel, stats: ChannelStats) -> int:
+        async with self.semaphore:
+            start = time.perf_counter()
+            inserted, skipped = await backfill_channel(self.bot.database,
+                    channel, self.page_size)
+            stats.last_latency = time.perf_counter() - start
+        metrics.LOOP_SECONDS.observe(stats.last_latency, loop="history")
+        metrics.CHANNEL_FETCH_SECONDS.set(stats.last_latency,
+                channel=str(channel.id))
+        if inserted:
+            log.info(f"Channel {channel.id}: stored {inserted} messages, "\
+                + f"skipped {skipped}.", extra={"channel": channel.id,
+                "inserted": inserted, "skipped": skipped,
+                "seconds": stats.last_latency})
+        stats.fetches += 1
+        stats.messages += inserted
+        stats.last_fetch = time.time()
+        return inserted
+
+def retry_after(error, default: float) -> float:
+    try:
+        return float(error.response.headers["Retry-After"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return default
+
+class MessageWriter:
+    # Collects messages pushed by the gateway events into a bounded queue and
+    # writes them to the database from a single task, one transaction per
+    # batch. A batch is flushed when it reaches batch_size messages or when
+    # flush_interval seconds have passed since its first message.
+    def __init__(self, database, batch_size: int = 500,
+                    flush_interval: float = 1.0, queue_size: int = 10000):
+        self.database = database
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.inserted = 0
+
+    async def put(self, message, edited: bool = False):
+        await self.queue.put((message.channel.id, message_record(message),
+                edited))
+
+    async def run(self):
+        batch = []
+        try:
+            while True:
+                batch = await self._next_batch()
+                try:
+                    with metrics.LOOP_SECONDS.time(loop="writer"):
+                        inserted, skipped = await self.database.run(
+                                self.flush, batch)
+                    self.inserted += inserted
+                except Exception as e:
+                    log.exception(f"Could not store {len(batch)} messages: "\
+                        + f"{str(e)}.")
+                batch = []
+        finally:
+            # Do not lose whatever was still waiting in the queue when the
+            # task is cancelled. The loop is going away, so write it here.
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            if batch:
+                with db.session_scope(self.database.session_factory) as session:
+                    self.flush(session, batch)
+
+    async def _next_batch(self) -> list:
+        loop = asyncio.get_event_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def flush(self, session, batch: list) -> tuple:
+        # Live messages never move the channel watermarks. Only the history
+        # reader does, so a message the gateway missed is still picked up by
+        # the next read of the channel.
+        records = [record for channel_id, record, edited in batch]
+        edits = [record for channel_id, record, edited in batch if edited]
+        inserted, skipped = db.add_messages(session, records, self.batch_size,
+                commit=False)
+        db.update_messages(session, edits, commit=False)
+        session.commit()
+        metrics.MESSAGES_INGESTED.inc(inserted, source="live")
+        metrics.message_stored(max(record["message_datetime"]
+                for record in records))
+        return inserted, skipped
@@ -0,0 +1,70 @@
+import asyncio
+import logging
+import time
+from DB import db
+
+# Several bot instances (one per shard range) may share one database. Work
+# that must happen only once is guarded by a named lease in the leases table:
+# closing proposals and archiving need the EXPIRY_LEASE and ARCHIVE_LEASE,
+# reading a channel needs its channel_lease. Every instance asks for the
+# leases of the work it can do and keeps renewing the ones it gets. When an
+# instance stops, its leases expire and are picked up by another.
+
+log = logging.getLogger(__name__)
+
+EXPIRY_LEASE = "expiry"
+ARCHIVE_LEASE = "archive"
+
+def channel_lease(channel_id: int) -> str:
+    return f"channel:{channel_id}"
+
+class LeaseKeeper:
+    # Takes and renews the wanted leases every duration / 3 seconds. A lease
+    # counts as held only until duration seconds after the renewal started,
+    # so an instance that cannot reach the database stops working before
+    # another instance can take over.
+    def __init__(self, database, holder: str, duration: float = 30):
+        self.database = database
+        self.holder = holder
+        self.duration = duration
+        self.wanted = set()
+        self.held = set()
+        self.valid_until = 0
+        self.wakeup = asyncio.Event()
+
+    def want(self, lease_name: str):
+        if lease_name not in self.wanted:
+            self.wanted.add(lease_name)
+            self.wakeup.set()
+
+    def holds(self, lease_name: str) -> bool:
+        return lease_name in self.held and time.monotonic() < self.valid_until
+
+    async def renew(self):
+        start = time.monotonic()
+        held = await self.database.run(db.acquire_leases,
+                sorted(self.wanted), self.holder, self.duration)
+        for lease_name in held - self.held:
+            log.info(f"{self.holder} took lease {lease_name}.",
+                    extra={"lease": lease_name, "holder": self.holder})
+        for lease_name in self.held - held:
+            log.info(f"{self.holder} lost lease {lease_name}.",
+                    extra={"lease": lease_name, "holder": self.holder})
+        self.held = held
+        self.valid_until = start + self.duration
+
+    async def run(self, is_closed):
+        while not is_closed():
+            self.wakeup.clear()
+            try:
+                await self.renew()
+            except Exception as e:
+                log.exception(f"Could not renew leases: {str(e)}.")
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.duration / 3)
+            except asyncio.TimeoutError:
+                pass
+
+    async def release(self):
+        self.held = set()
+        await self.database.run(db.release_leases, self.holder)
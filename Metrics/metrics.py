@@ -0,0 +1,232 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timezone
+
+# Prometheus style metrics kept in process and served as text on a local HTTP
+# endpoint, plus the JSON log format used for the [LOG] FILE.
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+        1, 2.5, 5, 10, 30)
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+def _format_labels(key: tuple) -> str:
+    if not key:
+        return ""
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"')\
+            .replace('\n', '\\n')) for name, value in key]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        with self.lock:
+            return self.values.get(_label_key(labels), 0)
+
+    def samples(self) -> list:
+        with self.lock:
+            return [(self.name, key, value) for key, value in \
+                    self.values.items()]
+
+class Gauge(Counter):
+    # A gauge either holds values set by the code or, if function is given,
+    # asks it for the current value on every scrape.
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, function=None):
+        super(Gauge, self).__init__(name, help_text)
+        self.function = function
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[_label_key(labels)] = value
+
+    def set_max(self, value: float, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            current = self.values.get(key)
+            if current is None or value > current:
+                self.values[key] = value
+
+    def samples(self) -> list:
+        if self.function is None:
+            return super(Gauge, self).samples()
+        value = self.function()
+        if value is None:
+            return []
+        return [(self.name, (), value)]
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # labels -> [bucket counts..., sum, count]
+        self.values = {}
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> list:
+        samples = []
+        with self.lock:
+            for key, series in self.values.items():
+                for bound, count in zip(self.buckets, series):
+                    samples.append((self.name + "_bucket", key + \
+                            (("le", repr(float(bound))),), count))
+                samples.append((self.name + "_bucket", key + (("le", "+Inf"),),
+                        series[-1]))
+                samples.append((self.name + "_sum", key, series[-2]))
+                samples.append((self.name + "_count", key, series[-1]))
+        return samples
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, key, value in metric.samples():
+                lines.append(f"{name}{_format_labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+DB_CALL_SECONDS = REGISTRY.register(Histogram("jardins_db_call_seconds",
+        "Time spent running a DB.db function, by function."))
+DB_WAIT_SECONDS = REGISTRY.register(Histogram("jardins_db_wait_seconds",
+        "Time a database call waited for a thread, by pool."))
+COMMAND_SECONDS = REGISTRY.register(Histogram("jardins_command_seconds",
+        "Time spent handling a bot command, by command."))
+LOOP_SECONDS = REGISTRY.register(Histogram("jardins_loop_seconds",
+        "Duration of one iteration of a background loop, by loop."))
+CHANNEL_FETCH_SECONDS = REGISTRY.register(Gauge(
+        "jardins_channel_fetch_seconds",
+        "Duration of the last history read of a channel."))
+MESSAGES_INGESTED = REGISTRY.register(Counter(
+        "jardins_messages_ingested_total",
+        "Messages stored, by source (live or history)."))
+MESSAGES_ARCHIVED = REGISTRY.register(Counter(
+        "jardins_messages_archived_total",
+        "Messages moved from the hot database to the archive."))
+VOTES_CAST = REGISTRY.register(Counter("jardins_votes_cast_total",
+        "Votes registered, by kind (new or moved)."))
+MESSAGES_SENT = REGISTRY.register(Counter("jardins_messages_sent_total",
+        "Outgoing Discord messages, by result (sent, retried or failed)."))
+PROPOSALS_CLOSED = REGISTRY.register(Counter("jardins_proposals_closed_total",
+        "Proposals closed, by outcome."))
+NEWEST_MESSAGE = REGISTRY.register(Gauge(
+        "jardins_newest_message_timestamp_seconds",
+        "Creation time of the newest stored message."))
+STARTUP_SECONDS = REGISTRY.register(Gauge("jardins_startup_seconds",
+        "Seconds from process start until the bot was first ready."))
+INGESTION_LAG = REGISTRY.register(Gauge("jardins_ingestion_lag_seconds",
+        "Seconds between now and the newest stored message.",
+        lambda: time.time() - NEWEST_MESSAGE.get() \
+                if NEWEST_MESSAGE.get() else None))
+
+def message_stored(created_at):
+    # discord.py gives naive datetimes in UTC.
+    NEWEST_MESSAGE.set_max(created_at.replace(tzinfo=timezone.utc).timestamp())
+
+async def serve(host: str, port: int, registry: Registry = REGISTRY):
+    # Minimal HTTP server answering every GET with the metrics text.
+    async def handle(reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            if request.split(b" ")[0] == b"GET":
+                body = registry.render().encode()
+                status = b"200 OK"
+            else:
+                body = b""
+                status = b"405 Method Not Allowed"
+            writer.write(b"HTTP/1.1 " + status + b"\r\n"\
+                    + b"Content-Type: text/plain; version=0.0.4\r\n"\
+                    + b"Content-Length: " + str(len(body)).encode() + b"\r\n"\
+                    + b"Connection: close\r\n\r\n" + body)
+            await writer.drain()
+        finally:
+            writer.close()
+    return await asyncio.start_server(handle, host, port)
+
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line. Anything passed through extra= is included.
+    reserved = set(vars(logging.makeLogRecord({})))
+
+    def format(self, record) -> str:
+        entry = {"time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+                "level": record.levelname, "logger": record.name,
+                "message": record.getMessage()}
+        for name, value in vars(record).items():
+            if name not in self.reserved and name not in entry:
+                entry[name] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+# Handlers added by setup_logging, replaced when it is called again.
+HANDLERS = []
+
+def setup_logging(log_file: str, level=logging.INFO):
+    directory = os.path.dirname(log_file)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    file_handler = logging.FileHandler(log_file)
+    file_handler.setFormatter(JsonFormatter())
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter("%(message)s"))
+    root = logging.getLogger()
+    root.setLevel(level)
+    for handler in HANDLERS:
+        root.removeHandler(handler)
+        handler.close()
+    HANDLERS[:] = [file_handler, console_handler]
+    root.addHandler(file_handler)
+    root.addHandler(console_handler)
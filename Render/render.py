@@ -0,0 +1,83 @@
+import threading
+from collections import OrderedDict
+
+# Text shown for a proposal in Discord. The templates are built once at import
+# and the rendered text is cached per (proposal_id, status), so announcing or
+# listing a proposal again costs a dictionary lookup. A proposal only changes
+# when it is closed, which changes the key; the closing code also drops the
+# old entry.
+
+DATETIME_FORMAT = "%d.%m.%Y %H:%M"
+
+HEADER = "Proposta {proposal_id}:\nProposta por {author}.\n\nTexto:\n{text}"\
+        + "\n\nOpções:\n{options}\n\n"
+
+TEMPLATES = {
+    "popen": HEADER + "Proposta aberta até: {expiration}. Pode votar sobre "\
+            + "esta proposta escrevendo !votar {proposal_id} opção# Por "\
+            + "exemplo, se quisesse votar a favor da primeira opção pode "\
+            + "escrever:\n !votar {proposal_id} 1",
+    "psucceeded": HEADER + "Proposta aprovada. Opção escholida: {decision}.",
+    "pfailed": HEADER + "Proposta falhada. Houve um empate ou não foram "\
+            + "recibidos votos.",
+}
+
+OPTION_TEMPLATE = "{number}. {text}"
+
+def format_options(options: list) -> str:
+    # options are (number, text) pairs in order.
+    return "\n".join(OPTION_TEMPLATE.format(number=number, text=text)
+            for number, text in options)
+
+class RenderCache:
+    # Least recently used cache of rendered text, shared by the event loop
+    # and the executor threads that close proposals.
+    def __init__(self, max_size: int = 256):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple, render):
+        with self.lock:
+            text = self.entries.get(key)
+            if text is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return text
+            self.misses += 1
+        text = render()
+        with self.lock:
+            self.entries[key] = text
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return text
+
+    def invalidate(self, proposal_id: int):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == proposal_id]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits,
+                    "misses": self.misses}
+
+RENDER_CACHE = RenderCache()
+
+def render_proposal(proposal_id: int, status: str, author: str, text: str,
+                        options: list, expiration, decision) -> str:
+    # status is the ProposalStatus name. Nothing is written back to the
+    # proposal.
+    def render():
+        return TEMPLATES[status].format(proposal_id=proposal_id,
+                author=author, text=text, options=format_options(options),
+                expiration=expiration.strftime(DATETIME_FORMAT),
+                decision=decision)
+    return RENDER_CACHE.get((proposal_id, status), render)
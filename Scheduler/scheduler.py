@@ -0,0 +1,107 @@
+import asyncio
+import heapq
+import logging
+from datetime import datetime
+from DB import db
+from Metrics import metrics
+
+log = logging.getLogger(__name__)
+
+class ExpiryScheduler:
+    # Keeps the expiration time of every open proposal in a min-heap and
+    # sleeps until the earliest one, instead of polling the proposals table.
+    # New proposals are pushed with add(), which wakes the scheduler up in
+    # case the new deadline is the earliest. Deadlines that passed while the
+    # bot was down are loaded as already due and closed straight away.
+    def __init__(self, database, announce, max_sleep: float = 3600,
+                    is_leader=None):
+        self.database = database
+        # Coroutine function called with the list of closed proposals.
+        self.announce = announce
+        # Upper bound on a single sleep, so a change of the system clock is
+        # noticed eventually. Waking up does not touch the database.
+        self.max_sleep = max_sleep
+        # With several instances on one database, only the one for which
+        # is_leader() returns True closes proposals. It reloads the deadlines
+        # every max_sleep seconds to see proposals registered elsewhere.
+        self.is_leader = is_leader
+        self.deadlines = []
+        self.wakeup = asyncio.Event()
+
+    async def load(self):
+        # Merged into the heap rather than replacing it, so a proposal added
+        # while the deadlines were being read is not dropped.
+        loaded = await self.database.read(db.get_open_proposal_deadlines)
+        self.deadlines = list(set(self.deadlines).union((expiration,
+                proposal_id) for proposal_id, expiration in loaded))
+        heapq.heapify(self.deadlines)
+
+    def add(self, proposal_id: int, expiration: datetime):
+        heapq.heappush(self.deadlines, (expiration, proposal_id))
+        self.wakeup.set()
+
+    def next_deadline(self) -> datetime:
+        if not self.deadlines:
+            return None
+        return self.deadlines[0][0]
+
+    async def run(self, is_closed):
+        await self.load()
+        leading = True
+        while not is_closed():
+            self.wakeup.clear()
+            if self.is_leader is not None and not self.is_leader():
+                leading = False
+                await asyncio.sleep(self.max_sleep)
+                continue
+            if not leading:
+                leading = await self.reload()
+                continue
+            now = datetime.now()
+            deadline = self.next_deadline()
+            if deadline is not None and deadline <= now:
+                await self.close_due(now)
+                continue
+            timeout = self.max_sleep
+            if deadline is not None:
+                timeout = min(timeout, (deadline - now).total_seconds())
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                if self.is_leader is not None:
+                    await self.reload()
+
+    async def reload(self) -> bool:
+        try:
+            await self.load()
+        except Exception as e:
+            log.exception(f"Could not load proposal deadlines: {str(e)}.")
+            await asyncio.sleep(1)
+            return False
+        return True
+
+    async def close_due(self, now: datetime):
+        try:
+            with metrics.LOOP_SECONDS.time(loop="expiry"):
+                proposals = await self.database.run(
+                        db.update_expiring_proposals)
+        except Exception as e:
+            log.exception(f"Could not close expiring proposals: {str(e)}.")
+            await asyncio.sleep(1)
+            return
+        while self.deadlines and self.deadlines[0][0] <= now:
+            heapq.heappop(self.deadlines)
+        for proposal in proposals:
+            outcome = db.ProposalStatus(proposal.proposal_decision_status).name
+            metrics.PROPOSALS_CLOSED.inc(outcome=outcome)
+            log.info(f"Closed proposal {proposal.proposal_id}.",
+                    extra={"proposal": proposal.proposal_id,
+                    "outcome": outcome})
+        if proposals:
+            # The proposals are closed already, a failed announcement must
+            # not stop the scheduler.
+            try:
+                await self.announce(proposals)
+            except Exception as e:
+                log.exception(f"Could not announce closed proposals: "\
+                    + f"{str(e)}.")
@@ -1,25 +1,77 @@
 #!/usr/bin/python3
+import time
+# Taken before the other imports, the startup time reported on ready
+# includes them.
+STARTED = time.perf_counter()
 import discord
 from discord.ext import commands
 from Config import config
 from DB import db
+from DB import executor
 from Exceptions import exceptions
+from Ingest import ingest
+from Scheduler import scheduler
+from Metrics import metrics
+from Archive import archive
+from Export import export
+from Dispatch import dispatch
+from Lease import lease
 import asyncio
+import logging
+import os
+import socket
+import tempfile
+from datetime import datetime, timedelta
 from sys import argv
 
-class JardinsEfemerosBot(commands.Bot):
+log = logging.getLogger("bot")
+
+class JardinsEfemerosBot(commands.AutoShardedBot):
     def __init__(self, init_file=None):
         self.options = config.read_config(init_file)
+        metrics.setup_logging(self.options.get("LOG", "FILE"))
         self.prefix = self.options.get("BOT", "PREFIX")
         self.description = self.options.get("BOT", "DESCRIPTION")
-        self.channels = self.options.get("BOT", "CHANNELS").split(';')
+        # Guilds can have their own [GUILD <guild id>] section with CHANNELS,
+        # PREFIX and RESULTS_CHANNEL. Their channels are read together with
+        # [BOT] CHANNELS.
+        self.guild_options = {int(section.split()[1]): self.options[section]
+                for section in self.options.sections()
+                if section.startswith("GUILD ")}
+        self.channels = [channel for channel in self.options.get("BOT",
+                "CHANNELS", fallback="").split(';') if channel]
+        # Results of proposals that do not say where they were made.
+        results_channel = self.options.get("BOT", "RESULTS_CHANNEL",
+                fallback="") or (self.channels[-1] if self.channels else "")
+        self.results_channel = int(results_channel) if results_channel \
+                else None
+        for guild in self.guild_options.values():
+            self.channels += [channel for channel in guild.get("CHANNELS",
+                    "").split(';') if channel]
+        self.batch_size = self.options.getint("DATABASE", "BATCH_SIZE",
+                fallback=500)
+        self.flush_interval = self.options.getfloat("BOT", "FLUSH_INTERVAL",
+                fallback=1.0)
+        self.queue_size = self.options.getint("BOT", "QUEUE_SIZE",
+                fallback=10000)
+        shard_ids = [int(shard_id) for shard_id in self.options.get("BOT",
+                "SHARD_IDS", fallback="").split(';') if shard_id]
+        shard_count = self.options.getint("BOT", "SHARD_COUNT", fallback=0)
+        if shard_ids and not shard_count:
+            raise exceptions.InvalidConfigException("[BOT] SHARD_IDS needs "\
+                + "SHARD_COUNT set to the total number of shards.")
         super(JardinsEfemerosBot, self).__init__(                              
-                command_prefix=self.prefix,                                     
-                description=self.description                                    
+                command_prefix=self.guild_prefix,
+                description=self.description,
+                shard_count=shard_count or None,
+                shard_ids=shard_ids or None
                 )                                                               
         self.token = self.options.get("SECRET", "TOKEN")                        
+        # Seconds spent in each step of the startup, logged on ready.
+        self.startup = {"imports": time.perf_counter() - STARTED}
         try:                                                                    
-            self.session = db.get_database(self.options)                        
+            # The schema is migrated in start(), while logging in.
+            self.session = db.get_database(self.options, migrate=False)
         except Exception as err:                                                
             if err.args[0] == 1045:                                             
                 err_text = "Access Denied"                                      
@@ -27,180 +79,611 @@ class JardinsEfemerosBot(commands.Bot):
                 err_text = "Connection Refused"                                 
             else:                                                               
                 err_text = f"Error {err.args[0]}"                               
-            print(err_text)                                                     
+            log.error(err_text)
             raise err
+        self.database = executor.DatabaseExecutor(self.session,
+                self.options.getint("DATABASE", "THREADS", fallback=4))
+        self.instance_id = self.options.get("BOT", "INSTANCE_ID",
+                fallback="") or f"{socket.gethostname()}:{os.getpid()}"
+        # Leases are only needed when several instances share the database.
+        # A single instance does everything and leaves the database idle.
+        self.leases = None
+        if self.options.getint("BOT", "INSTANCES", fallback=1) > 1:
+            self.leases = lease.LeaseKeeper(self.database, self.instance_id,
+                    self.options.getfloat("BOT", "LEASE_SECONDS",
+                    fallback=30))
+            self.leases.want(lease.EXPIRY_LEASE)
+            self.leases.want(lease.ARCHIVE_LEASE)
+        self.writer = ingest.MessageWriter(self.database, self.batch_size,
+                self.flush_interval, self.queue_size)
+        self.scheduler = ingest.ChannelScheduler(self, self.writer,
+                self.options.getint("BOT", "FETCH_CONCURRENCY", fallback=4),
+                self.batch_size,
+                self.options.getfloat("BOT", "POLL_MIN_INTERVAL", fallback=10),
+                self.options.getfloat("BOT", "POLL_MAX_INTERVAL",
+                    fallback=600), self.leases)
+        if self.leases is None:
+            self.expiry = scheduler.ExpiryScheduler(self.database,
+                    self.announce_proposals)
+        else:
+            self.expiry = scheduler.ExpiryScheduler(self.database,
+                    self.announce_proposals, self.leases.duration,
+                    lambda: self.holds(lease.EXPIRY_LEASE))
+        self.dispatcher = dispatch.Dispatcher(
+                self.options.getfloat("BOT", "SEND_INTERVAL", fallback=1.0),
+                self.options.getfloat("BOT", "SEND_COALESCE", fallback=0.25))
+        self.register_metrics()
+
+    def register_metrics(self):
+        metrics.REGISTRY.register(metrics.Gauge("jardins_db_queue_depth",
+                "Database calls waiting for a thread.",
+                lambda: self.database.queue_depth))
+        metrics.REGISTRY.register(metrics.Gauge("jardins_db_leaked_sessions",
+                "Database sessions garbage collected without being closed.",
+                lambda: db.TrackedSession.leaked))
+        metrics.REGISTRY.register(metrics.Gauge(
+                "jardins_db_long_open_sessions",
+                "Database sessions open for more than a minute.",
+                lambda: len(db.leaked_sessions())))
+        metrics.REGISTRY.register(metrics.Gauge("jardins_send_queue_depth",
+                "Outgoing messages waiting to be sent.",
+                lambda: self.dispatcher.queue_depth()))
+        if self.leases is not None:
+            metrics.REGISTRY.register(metrics.Gauge("jardins_leases_held",
+                    "Leases held by this instance.",
+                    lambda: len(self.leases.held)))
+        metrics.REGISTRY.register(metrics.Gauge("jardins_write_queue_depth",
+                "Messages waiting to be written.",
+                lambda: self.writer.queue.qsize()))
+        metrics.REGISTRY.register(metrics.Gauge(
+                "jardins_proposal_cache_hits",
+                "Proposal cache hits.",
+                lambda: db.PROPOSAL_CACHE.hits))
+        metrics.REGISTRY.register(metrics.Gauge(
+                "jardins_proposal_cache_misses",
+                "Proposal cache misses.",
+                lambda: db.PROPOSAL_CACHE.misses))
 
     def run(self):
         super(JardinsEfemerosBot, self).run(self.token)
 
-bot = JardinsEfemerosBot()
-
-@bot.event                                                                      
-async def on_ready():                                                           
-    print("Logged in as:")                                                      
-    print(bot.user.name)                                                        
-    print(bot.user.id)                                                          
-    print('-------')
-
-async def read_messages():
-    await bot.wait_until_ready()
-    counter = 0
-    # Fill in a filter based on last seen, eventually.
-    last_message = db.get_last_message_time(bot.session())
-    print(last_message)
-    session = bot.session()
-    while not bot.is_closed():
-        for channel_id in bot.channels:
-            channel = bot.get_channel(int(channel_id))
+    async def start(self, *args, **kwargs):
+        # Logs in while the database is migrated on the writer thread. The
+        # gateway is connected once both are done, so no event or command
+        # reaches the database before its schema is current.
+        reconnect = kwargs.pop("reconnect", True)
+        await asyncio.gather(self.timed("login", self.login(*args, **kwargs)),
+                self.timed("database", self.loop.run_in_executor(
+                self.database.writer, db.migrate_database,
+                self.session.kw["bind"])))
+        self.start_tasks()
+        await self.connect(reconnect=reconnect)
+
+    async def timed(self, step: str, awaitable):
+        start = time.perf_counter()
+        result = await awaitable
+        self.startup[step] = time.perf_counter() - start
+        return result
+
+    def start_tasks(self):
+        if self.leases is not None:
+            self.loop.create_task(self.leases.run(self.is_closed))
+        self.loop.create_task(self.serve_metrics())
+        self.loop.create_task(self.archive_messages())
+        self.loop.create_task(self.writer.run())
+        self.loop.create_task(self.read_messages())
+        self.loop.create_task(self.handle_proposals())
+
+    async def on_ready(self):
+        log.info(f"Logged in as: {self.user.name} ({self.user.id})",
+                extra={"user": self.user.id})
+        if "ready" not in self.startup:
+            # Only the first time, on_ready also follows a reconnect.
+            self.startup["ready"] = time.perf_counter() - STARTED
+            metrics.STARTUP_SECONDS.set(self.startup["ready"])
+            steps = ", ".join(f"{step} {seconds:.2f} s" for step, seconds
+                    in self.startup.items() if step != "ready")
+            log.info(f"Ready {self.startup['ready']:.2f} s after start "\
+                + f"({steps}).", extra=self.startup)
+
+    def guild_prefix(self, bot, message):
+        if message.guild is not None and \
+                message.guild.id in self.guild_options:
+            return self.guild_options[message.guild.id].get("PREFIX",
+                    self.prefix)
+        return self.prefix
+
+    def ingests(self, channel_id: int) -> bool:
+        # Live messages are stored by the instance that reads the channel
+        # history, the one holding the channel lease.
+        return str(channel_id) in self.channels and \
+                self.holds(lease.channel_lease(channel_id))
+
+    def holds(self, lease_name: str) -> bool:
+        return self.leases is None or self.leases.holds(lease_name)
+
+    def results_channel_id(self, proposal):
+        # The RESULTS_CHANNEL of the proposal's guild, else the channel it
+        # was made in, else [BOT] RESULTS_CHANNEL.
+        guild = self.guild_options.get(proposal.proposal_guild)
+        if guild is not None and guild.get("RESULTS_CHANNEL"):
+            return int(guild.get("RESULTS_CHANNEL"))
+        if proposal.proposal_channel is not None:
+            return proposal.proposal_channel
+        return self.results_channel
+
+    async def announce_proposals(self, proposals):
+        # The channel may be on a shard of another instance.
+        channels = {}
+        for proposal in proposals:
+            channel_id = self.results_channel_id(proposal)
             try:
-                messages = await channel.history(limit=None, after=last_message).flatten()
+                if channel_id is None:
+                    raise ValueError("no results channel configured")
+                if channel_id not in channels:
+                    channels[channel_id] = self.get_channel(channel_id) \
+                            or await self.fetch_channel(channel_id)
             except Exception as e:
+                log.exception(f"Could not announce proposal "\
+                    + f"{proposal.proposal_id}: {str(e)}.",
+                    extra={"proposal": proposal.proposal_id})
                 continue
-            for message in messages:
-                if message.created_at >= last_message:
-                    last_message = message.created_at
-                    db.add_message(session, message.id,
-                        message.author.display_name, message.created_at,
-                        message.clean_content)
-        await asyncio.sleep(10)
-    session.close()
-
-async def handle_proposals():
-    await bot.wait_until_ready()
-    # Here we're going to look through the proposals table, find the ones that
-    # are a certain amount of time from expiring, and print a reminder to vote
-    # for them. We will also loop for expiring proposals, close them, and print
-    # the results.
-    session = bot.session()
-    while not bot.is_closed():
-        proposals = db.update_expiring_proposals(session)
-        for channel_id in bot.channels:
-            channel = bot.get_channel(int(channel_id))
-        for proposal in proposals:
-            await channel.send(str(proposal))
-            
-        await asyncio.sleep(10)
-    session.close()
+            self.dispatcher.send(channels[channel_id], str(proposal))
+
+    def reply(self, ctx, content: str):
+        # Command replies go through the dispatcher, the handler does not
+        # wait for Discord.
+        return self.dispatcher.send(ctx.channel, content)
+
+    async def store_message(self, message):
+        if self.ingests(message.channel.id):
+            await self.writer.put(message)
+
+    async def store_edit(self, before, after):
+        if self.ingests(after.channel.id):
+            await self.writer.put(after, edited=True)
+
+    async def serve_metrics(self):
+        # Prometheus scrape endpoint, disabled with a PORT of 0.
+        port = self.options.getint("METRICS", "PORT", fallback=9100)
+        if port <= 0:
+            return
+        last_message = await self.database.read(db.get_last_message_time)
+        metrics.message_stored(last_message)
+        host = self.options.get("METRICS", "HOST", fallback="127.0.0.1")
+        try:
+            self.metrics_server = await metrics.serve(host, port)
+        except OSError as e:
+            # Usually another instance on this machine has the port.
+            log.error(f"Could not serve metrics on {host}:{port}: {str(e)}.",
+                    extra={"host": host, "port": port})
 
-bot.loop.create_task(read_messages())
-bot.loop.create_task(handle_proposals())
+    async def read_messages(self):
+        # Catch up on whatever was posted while the bot was offline, then
+        # keep re-reading the channels in the background in case the gateway
+        # misses something. New messages are normally captured live by
+        # store_message/store_edit.
+        await self.wait_until_ready()
+        await self.scheduler.run(self.channels)
 
-@bot.command(help="Propor uma votação para EdenX.", 
+    async def handle_proposals(self):
+        await self.wait_until_ready()
+        # Closes proposals as they expire and prints the results. The
+        # scheduler sleeps until the next deadline, propor wakes it up when a
+        # proposal is registered. Only the instance holding the expiry lease
+        # closes them.
+        await self.expiry.run(self.is_closed)
+
+    async def archive_messages(self):
+        # Moves messages older than [ARCHIVE] AGE_DAYS out of the hot
+        # database, one small batch at a time so live ingestion keeps flowing
+        # in between. An AGE_DAYS of 0 disables archiving. Only the instance
+        # holding the archive lease moves messages.
+        age = self.options.getint("ARCHIVE", "AGE_DAYS", fallback=180)
+        if age <= 0:
+            return
+        archive_dir = self.options.get("ARCHIVE", "DIR",
+                fallback=os.path.join(os.path.dirname(self.options.get(
+                "DATABASE", "FILE")), "archive"))
+        batch_size = self.options.getint("ARCHIVE", "BATCH_SIZE",
+                fallback=1000)
+        interval = self.options.getfloat("ARCHIVE", "INTERVAL_HOURS",
+                fallback=6)
+        await self.wait_until_ready()
+        while not self.is_closed():
+            if not self.holds(lease.ARCHIVE_LEASE):
+                await asyncio.sleep(self.leases.duration)
+                continue
+            cutoff = datetime.utcnow() - timedelta(days=age)
+            moved = 0
+            try:
+                with metrics.LOOP_SECONDS.time(loop="archive"):
+                    while True:
+                        batch = await self.database.run(archive.archive_batch,
+                                archive_dir, cutoff, batch_size)
+                        moved += batch
+                        if batch < batch_size:
+                            break
+                        await asyncio.sleep(0)
+            except Exception as e:
+                log.exception(f"Could not archive messages: {str(e)}.")
+            if moved:
+                log.info(f"Archived {moved} messages older than {cutoff}.",
+                        extra={"archived": moved})
+            await asyncio.sleep(interval * 3600)
+
+    async def close(self):
+        # Announcements are only queued after the proposals were closed, send
+        # what is left before the connection goes away.
+        await self.dispatcher.close()
+        if self.leases is not None:
+            try:
+                await self.leases.release()
+            except Exception as e:
+                log.exception(f"Could not release leases: {str(e)}.")
+        await super(JardinsEfemerosBot, self).close()
+        self.database.shutdown()
+
+
+async def start_command_timer(ctx):
+    ctx.command_started = time.perf_counter()
+
+async def stop_command_timer(ctx):
+    elapsed = time.perf_counter() - ctx.command_started
+    metrics.COMMAND_SECONDS.observe(elapsed, command=ctx.command.name)
+    log.info(f"Command {ctx.command.name} took {elapsed * 1000:.1f} ms.",
+            extra={"command": ctx.command.name, "seconds": elapsed})
+
+@commands.command(help="Propor uma votação para EdenX.", 
         cog="Proposta")
 async def propor(ctx, number_of_days: int, proposal: str, *options):
     # Do register a proposal for others to vote on.
     try:
-        session = bot.session()
         assert(type(number_of_days) == int)
         if number_of_days <= 0:
-            print("ERROR: Number of days to votes must be greater than"\
+            log.error("Number of days to votes must be greater than"\
                 + " zero.")
-            await ctx.send(f"{ctx.author.mention}: Não consegui registar a sua proposta."\
+            ctx.bot.reply(ctx, f"{ctx.author.mention}: Não consegui registar a sua proposta."\
                + "O número de dias para votar deve ser superior a zero.")
             return False
         elif number_of_days > 30:
-            print("ERROR: Number of days to votes must be less than"\
+            log.error("Number of days to votes must be less than"\
                 + " thirty.")
-            await ctx.send(f"{ctx.author.mention}: Não consegui registar a sua proposta."\
+            ctx.bot.reply(ctx, f"{ctx.author.mention}: Não consegui registar a sua proposta."\
                + "O número de dias para votar deve ser inferior a 31.")
             return False
-        options_str = "%;%".join(options)
-        proposal = db.add_proposal(session, proposal, ctx.author.display_name, 
-                options_str, number_of_days)
+        proposal = await ctx.bot.database.run(db.add_proposal, proposal,
+                ctx.author.display_name, list(options), number_of_days,
+                ctx.guild.id if ctx.guild else None, ctx.channel.id)
         if proposal is not None:
-            await ctx.send(f"{ctx.author.mention} registou uma nova proposta:\n"\
+            ctx.bot.expiry.add(proposal.proposal_id, proposal.proposal_expiration)
+            ctx.bot.reply(ctx, f"{ctx.author.mention} registou uma nova proposta:\n"\
                 + f" {str(proposal)}")
-            session.close()
             return True
         else:
             raise Exception("Proposal is None. The registration did not "\
                 + "succeed.")
     except AssertionError as a:
-        ctx.send("Erro: este comando esperava um número mas forneceu outra "\
+        ctx.bot.reply(ctx, "Erro: este comando esperava um número mas forneceu outra "\
             + "coisa. Um exemplo deste comando é:\n !propor 3 \"Devemos "\
             + "plantar tulipas no jardim?\" \"Sim, muitas\" \"Sim, "\
             + "algumas\" \"Não\"")
     except Exception as e:
-        print(f"ERROR: Unexpected error: {str(e)}.")
-        await ctx.send(f"{ctx.author.mention}: Não consegui registar a sua proposta.") 
-        sesssion.close()
+        log.exception(f"Unexpected error: {str(e)}.")
+        ctx.bot.reply(ctx, f"{ctx.author.mention}: Não consegui registar a sua proposta.") 
+        return False
+
+@commands.command(help="Mostrar os resultados actuais de uma proposta.",
+        cog="Resultados")
+async def resultados(ctx, proposal_id: int):
+    proposal = await ctx.bot.database.read(db.get_proposal, proposal_id)
+    if proposal is None:
+        ctx.bot.reply(ctx, f"{ctx.author.mention}, a proposta {proposal_id} "\
+            + "não existe.")
+        return False
+    tally = await ctx.bot.database.read(db.get_tally, proposal_id)
+    lines = [f"Resultados da proposta {proposal_id}:"]
+    for option in proposal.options:
+        lines.append(f"{option.option_number}. {option.option_text}: "\
+            + f"{tally.get(option.option_number, 0)} votos")
+    lines.append(f"Total: {sum(tally.values())} votos")
+    ctx.bot.reply(ctx, "\n".join(lines))
+    return True
+
+@commands.command(help="Mostrar o painel de uma proposta: votos por opção e "\
+        + "participação.", cog="Painel")
+async def painel(ctx, proposal_id: int):
+    proposal, tally, participants = await ctx.bot.database.read(
+            db.get_proposal_panel, proposal_id)
+    if proposal is None:
+        ctx.bot.reply(ctx, f"{ctx.author.mention}, a proposta {proposal_id} "\
+            + "não existe.")
+        return False
+    total = sum(tally.values())
+    lines = [f"Painel da proposta {proposal_id}: {proposal.proposal_text}"]
+    if proposal.proposal_decision_status == db.ProposalStatus.popen.value:
+        lines.append("Aberta até "\
+            + proposal.proposal_expiration.strftime("%d.%m.%Y %H:%M") + ".")
+    elif proposal.proposal_decision_status == \
+            db.ProposalStatus.psucceeded.value:
+        lines.append(f"Aprovada, opção escolhida: "\
+            + f"{proposal.proposal_decision}.")
+    else:
+        lines.append("Falhada.")
+    for option in proposal.options:
+        votes = tally.get(option.option_number, 0)
+        share = votes / total if total else 0
+        lines.append(f"{option.option_number}. {option.option_text}: "\
+            + f"{votes} votos ({share:.0%}) " + "█" * round(share * 10))
+    if participants:
+        lines.append(f"Votaram {total} de {participants} participantes "\
+            + f"({total / participants:.0%}).")
+    else:
+        lines.append(f"Votaram {total} participantes.")
+    ctx.bot.reply(ctx, "\n".join(lines))
+    return True
+
+@commands.command(help="Mostrar a participação de um membro (ou a sua): "\
+        + "mensagens, propostas e votos.", cog="Participacao")
+async def participacao(ctx, membro: discord.Member = None):
+    if membro is None:
+        membro = ctx.author
+    stats, proposals, votes = await ctx.bot.database.read(
+            db.get_participation, membro.display_name)
+    if stats is None:
+        ctx.bot.reply(ctx, f"{ctx.author.mention}, ainda não tenho registo "\
+            + f"da participação de {membro.display_name}.")
+        return False
+    lines = [f"Participação de {membro.display_name}:"]
+    messages = f"Mensagens: {stats.stats_messages}"
+    if stats.stats_first_seen is not None:
+        messages += " (desde "\
+            + stats.stats_first_seen.strftime("%d.%m.%Y") + ", última "\
+            + f"actividade {stats.stats_last_seen.strftime('%d.%m.%Y')})"
+    lines.append(messages + ".")
+    lines.append(f"Propostas feitas: {stats.stats_proposals}.")
+    share = stats.stats_votes / proposals if proposals else 0
+    lines.append(f"Votou em {stats.stats_votes} de {proposals} propostas "\
+        + f"({share:.0%}).")
+    if votes:
+        lines.append("Últimos votos:")
+    for proposal_id, proposal_text, choice, option_text in votes:
+        if len(proposal_text) > 60:
+            proposal_text = proposal_text[:60] + "…"
+        lines.append(f" Proposta {proposal_id} ({proposal_text}): "\
+            + f"{choice}. {option_text}")
+    ctx.bot.reply(ctx, "\n".join(lines))
+    return True
+
+@commands.command(help="Procurar mensagens arquivadas. Filtros opcionais: "\
+        + "autor:Nome desde:AAAA-MM-DD ate:AAAA-MM-DD pagina:N arquivo:sim "\
+        + "(para procurar nas mensagens antigas)", cog="Procura")
+async def procurar(ctx, *args):
+    terms = []
+    filters = {}
+    for arg in args:
+        name, separator, value = arg.partition(':')
+        if separator and name in ("autor", "desde", "ate", "pagina",
+                "arquivo"):
+            filters[name] = value
+        else:
+            terms.append(arg)
+    try:
+        since = until = None
+        if "desde" in filters:
+            since = datetime.strptime(filters["desde"], "%Y-%m-%d")
+        if "ate" in filters:
+            # ate is inclusive, the search stops before the next day.
+            until = datetime.strptime(filters["ate"], "%Y-%m-%d")\
+                    + timedelta(days=1)
+        page = int(filters.get("pagina", 1))
+    except ValueError:
+        ctx.bot.reply(ctx, f"{ctx.author.mention}, as datas devem ser escritas "\
+            + "como AAAA-MM-DD e a página como um número. Por exemplo:\n "\
+            + "!procurar tulipas autor:Maria desde:2022-01-01 pagina:2")
+        return False
+    if not terms and not {"autor", "desde", "ate"} & filters.keys():
+        ctx.bot.reply(ctx, f"{ctx.author.mention}, indique palavras ou "\
+            + "filtros para procurar. Por exemplo:\n "\
+            + "!procurar tulipas autor:Maria desde:2022-01-01 pagina:2")
+        return False
+    search = db.search_messages
+    if filters.get("arquivo") == "sim":
+        search = archive.search_archive
+    try:
+        messages, more = await ctx.bot.database.read(search, terms,
+                filters.get("autor"), since, until, page)
+    except exceptions.SearchUnavailableException:
+        ctx.bot.reply(ctx, f"{ctx.author.mention}, a procura não está "\
+            + "disponível neste servidor.")
+        return False
+    if not messages:
+        ctx.bot.reply(ctx, f"{ctx.author.mention}, não encontrei nenhuma "\
+            + "mensagem.")
+        return True
+    lines = [f"Resultados (página {page}):"]
+    for message in messages:
+        content = message.message_content
+        if len(content) > 150:
+            content = content[:150] + "…"
+        lines.append(message.message_datetime.strftime("[%d.%m.%Y %H:%M] ")\
+            + f"{message.message_author}: {content}")
+    if more:
+        lines.append(f"Há mais resultados, use pagina:{page + 1}.")
+    ctx.bot.reply(ctx, "\n".join(lines))
+    return True
+
+EXPORT_USAGE = "!exportar messages|proposals|votes|options "\
+        + "csv|jsonl|parquet [AAAA-MM-DD] [AAAA-MM-DD] [proposta:N]"
+
+@commands.command(help="Exportar mensagens, propostas ou votos (só "\
+        + f"administradores). Uso: {EXPORT_USAGE}. As datas só se aplicam a "\
+        + "messages e proposals, a proposta a proposals, votes e options.",
+        cog="Exporta")
+@commands.has_permissions(administrator=True)
+async def exportar(ctx, table: str, export_format: str = "csv", *args):
+    dates = [arg for arg in args if not arg.startswith("proposta:")]
+    proposals = [arg[len("proposta:"):] for arg in args
+            if arg.startswith("proposta:")]
+    if table not in export.TABLES or export_format not in export.FORMATS\
+            or len(dates) > 2 or len(proposals) > 1:
+        ctx.bot.reply(ctx, f"{ctx.author.mention}, uso: {EXPORT_USAGE}")
+        return False
+    try:
+        since, until = [export.parse_date(date) for date in dates]\
+                + [None] * (2 - len(dates))
+    except ValueError:
+        ctx.bot.reply(ctx, f"{ctx.author.mention}, as datas devem ser escritas "\
+            + "como AAAA-MM-DD.")
+        return False
+    try:
+        proposal_id = int(proposals[0]) if proposals else None
+    except ValueError:
+        ctx.bot.reply(ctx, f"{ctx.author.mention}, a proposta deve ser um "\
+            + "número. Por exemplo: proposta:3")
+        return False
+    if dates and table not in export.DATED_TABLES:
+        ctx.bot.reply(ctx, f"{ctx.author.mention}, a tabela {table} não tem "\
+            + "datas, as datas só se aplicam a messages e proposals.")
+        return False
+    if proposal_id is not None and table not in export.PROPOSAL_TABLES:
+        ctx.bot.reply(ctx, f"{ctx.author.mention}, a tabela {table} não tem "\
+            + "propostas, a proposta só se aplica a proposals, votes e "\
+            + "options.")
+        return False
+    directory = tempfile.mkdtemp(prefix="jardins-export-")
+    path = os.path.join(directory, f"{table}.{export_format}")
+    try:
+        count = await ctx.bot.database.read(export.export, table, export_format,
+                path, since, until, proposal_id)
+        if os.path.getsize(path) > 8 * 1024 * 1024:
+            ctx.bot.reply(ctx, f"{ctx.author.mention}, a exportação tem "\
+                + f"{count} linhas e é grande demais para o Discord. Use "\
+                + "python3 -m Export.export no servidor.")
+            return False
+        await ctx.send(f"{ctx.author.mention}, exportei {count} linhas.",
+                file=discord.File(path))
+        return True
+    except Exception as e:
+        log.exception(f"Export failed: {str(e)}.")
+        ctx.bot.reply(ctx, f"{ctx.author.mention}, não consegui exportar os "\
+            + "dados.")
         return False
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+        os.rmdir(directory)
 
-@bot.command(help="Votar para uma proposta.", cog="Vota")
+@commands.command(help="Mostrar o estado da leitura dos canais.", cog="Canais")
+async def canais(ctx):
+    lines = []
+    for channel_id, stats in ctx.bot.scheduler.stats.items():
+        if stats.last_latency is None:
+            latency = "-"
+        else:
+            latency = f"{stats.last_latency * 1000:.0f} ms"
+        lines.append(f"<#{channel_id}>: {stats.fetches} leituras, "\
+            + f"{stats.messages} mensagens, última leitura {latency}, "\
+            + f"próxima em {stats.interval:.0f} s.")
+    if not lines:
+        lines.append("Ainda não li nenhum canal.")
+    ctx.bot.reply(ctx, "\n".join(lines))
+
+@commands.command(help="Votar para uma proposta.", cog="Vota")
 async def votar(ctx, proposal_id: int, option: int):
-    session = bot.session()
     try:
         assert(type(proposal_id) == int)
         assert(type(option) == int)
 
-        proposal = db.get_proposal(bot.session(), proposal_id)
-        if proposal is None:
-            raise exceptions.ProposalDoesNotExistException()
-        elif proposal.proposal_decision_status != db.ProposalStatus.popen.value:
-            raise exceptions.ProposalClosedException()
-        else:
-            try:
-                db.add_vote(session, proposal_id, option, ctx.author.display_name)
-                await ctx.send(f"{ctx.author.mention}, registei com successo "\
-                    + f"o seu voto para proposta {proposal_id}.")
-                session.close()
-                return True
-            except Exception as e:
-                raise e
+        # add_vote checks the proposal exists and is open.
+        await ctx.bot.database.run(db.add_vote, proposal_id, option,
+                ctx.author.display_name, ctx.guild.id if ctx.guild else None)
+        metrics.VOTES_CAST.inc(kind="new")
+        ctx.bot.reply(ctx, f"{ctx.author.mention}, registei com successo "\
+            + f"o seu voto para proposta {proposal_id}.")
+        return True
     except AssertionError as e:
-        await ctx.send("Error: Este comando está à espera de números mas " \
+        ctx.bot.reply(ctx, "Error: Este comando está à espera de números mas " \
             + "forneceu algo diferente. Um exemplo deste comando é: \n " \
             + "!votar 1 2\nEste comando escolhe a opção 2 na proposta número 1.")
     except exceptions.DoubleVotingException as e:
-        await ctx.send(f"{ctx.author.mention}, não consegui registar o seu "\
+        ctx.bot.reply(ctx, f"{ctx.author.mention}, não consegui registar o seu "\
             + "voto, uma vez que já votou sobre esta proposta.")
     except exceptions.InvalidVoteException as e:
-        await ctx.send(f"{ctx.author.mention}, não consegui registar o seu "\
+        ctx.bot.reply(ctx, f"{ctx.author.mention}, não consegui registar o seu "\
             + "voto, uma vez que esta opção não existe.")
+    except exceptions.ProposalClosedException as e:
+        ctx.bot.reply(ctx, f"{ctx.author.mention}, não consegui registar o seu "\
+            + "voto, uma vez que esta proposta já está fechada.")
+    except exceptions.ProposalDoesNotExistException as e:
+        ctx.bot.reply(ctx, f"{ctx.author.mention}, não consegui registar o seu "\
+            + f"voto, uma vez que a proposta {proposal_id} não existe.")
     except Exception as e:
-        await ctx.send(f"{ctx.author.mention}, não consegui registar o seu "\
+        ctx.bot.reply(ctx, f"{ctx.author.mention}, não consegui registar o seu "\
             + "voto devido a um error inesperado.")
-        #print(f"ERROR: Vote failed due to {e.with_traceback()}.")
-    session.close()
+        log.exception(f"Unexpected error: {str(e)}.")
     return False
 
-@bot.command(help="Mudar o seu voto numa proposta", cog="Muda")
+@commands.command(help="Mudar o seu voto numa proposta", cog="Muda")
 async def mudar_voto(ctx, proposal_id: int, option: int):
-    session = bot.session()
     try:
         assert(type(proposal_id)==int)
         assert(type(option)==int)
-        proposal = db.get_proposal(bot.session(), proposal_id)
-        if proposal is None:
-            raise exceptions.ProposalDoesNotExistException()
-        elif proposal.proposal_decision_status != db.ProposalStatus.popen.value:
-            raise exceptions.ProposalClosedException()
-        else:
-            try:
-                db.move_vote(session, proposal_id, option, ctx.author.display_name)
-                await ctx.send(f"{ctx.author.mention}, mudei o seu voto "\
-                        + f"na proposta {proposal_id} com successo.")
-                session.close()
-                return True
-            except Exception as e:
-                raise e
+        # move_vote checks the proposal exists and is open.
+        await ctx.bot.database.run(db.move_vote, proposal_id, option,
+                ctx.author.display_name, ctx.guild.id if ctx.guild else None)
+        metrics.VOTES_CAST.inc(kind="moved")
+        ctx.bot.reply(ctx, f"{ctx.author.mention}, mudei o seu voto "\
+                + f"na proposta {proposal_id} com successo.")
+        return True
     except AssertionError as e:
-        await ctx.send("Error: Este comando está à espera de números mas " \
+        ctx.bot.reply(ctx, "Error: Este comando está à espera de números mas " \
             + "forneceu algo diferente. Um exemplo deste comando é: \n " \
             + "!mudar_voto 2 1\nEste comando muda o seu voto para a opção 1 "\
             + "na proposta número 1.")
     except exceptions.VoteDoesntExistException as e:
-        await ctx.send(f"{ctx.author.mention}, não consegui mudar o seu "\
+        ctx.bot.reply(ctx, f"{ctx.author.mention}, não consegui mudar o seu "\
             + "voto, uma vez que ainda não votou sobre esta proposta.")
     except exceptions.InvalidVoteException as e:
-        await ctx.send(f"{ctx.author.mention}, não consegui registar o seu "\
+        ctx.bot.reply(ctx, f"{ctx.author.mention}, não consegui registar o seu "\
             + "voto, uma vez que esta opção não existe.")
+    except exceptions.ProposalClosedException as e:
+        ctx.bot.reply(ctx, f"{ctx.author.mention}, não consegui registar o seu "\
+            + "voto, uma vez que esta proposta já está fechada.")
+    except exceptions.ProposalDoesNotExistException as e:
+        ctx.bot.reply(ctx, f"{ctx.author.mention}, não consegui registar o seu "\
+            + f"voto, uma vez que a proposta {proposal_id} não existe.")
     except Exception as e:
-        await ctx.send(f"{ctx.author.mention}, não consegui registar o seu "\
+        ctx.bot.reply(ctx, f"{ctx.author.mention}, não consegui registar o seu "\
             + "voto devido a um error inesperado.")
-        #print(f"ERROR: Vote failed due to {e.with_traceback()}.")
-    session.close()
+        log.exception(f"Unexpected error: {str(e)}.")
     return False
-        
 
-bot.run() 
+COMMANDS = [propor, resultados, painel, participacao, procurar, exportar,
+        canais, votar, mudar_voto]
+
+def create_bot(init_file=None) -> JardinsEfemerosBot:
+    # Builds the bot without connecting to Discord or touching the database
+    # schema, both happen in JardinsEfemerosBot.start.
+    start = time.perf_counter()
+    bot = JardinsEfemerosBot(init_file)
+    for command in COMMANDS:
+        bot.add_command(command)
+    bot.before_invoke(start_command_timer)
+    bot.after_invoke(stop_command_timer)
+    bot.add_listener(bot.store_message, "on_message")
+    bot.add_listener(bot.store_edit, "on_message_edit")
+    bot.startup["setup"] = time.perf_counter() - start
+    return bot
+
+def main():
+    try:
+        bot = create_bot(argv[1] if len(argv) > 1 else None)
+    except (exceptions.ConfigCreatedException,
+            exceptions.InvalidConfigException) as e:
+        print(str(e))
+        return
+    bot.run()
+
+if __name__ == "__main__":
+    main()